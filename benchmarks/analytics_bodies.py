@@ -0,0 +1,89 @@
+"""
+Analytics bytes for agent-style conversations: every request resends the
+system prompt and the whole history. Compares the prompt and response text
+stored inline in each row against message bodies stored once by hash, both
+as sent to ClickHouse and after ZSTD(3), the codec of the body columns.
+
+    python benchmarks/analytics_bodies.py [--conversations 50] [--turns 30] [--system-bytes 6000]
+
+Text is random words, so compression only finds the repeats, not the
+redundancy of real prose.
+"""
+import argparse
+import json
+import random
+import string
+import sys
+from pathlib import Path
+
+import zstandard
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import analytics
+
+BLOCK = 1024 * 1024
+
+
+def words(n, rng):
+    return " ".join("".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(n))
+
+
+def conversation_rows(turns, system_bytes, rng):
+    system = {"role": "system", "content": words(system_bytes // 6, rng)}
+    messages = [system]
+    rows = []
+    for _ in range(turns):
+        messages.append({"role": "user", "content": words(rng.randint(10, 80), rng)})
+        response = words(rng.randint(40, 300), rng)
+        rows.append({"id": str(rng.random()), "prompt_text": json.dumps(messages), "response_text": response})
+        messages.append({"role": "assistant", "content": response})
+    return rows
+
+
+def compressed_size(data, compressor):
+    # ClickHouse compresses a column in blocks of at most max_compress_block_size (1 MiB)
+    return sum(len(compressor.compress(data[start:start + BLOCK])) for start in range(0, len(data), BLOCK))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--system-bytes", type=int, default=6000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    conversations = [conversation_rows(args.turns, args.system_bytes, rng) for _ in range(args.conversations)]
+    # Concurrent conversations, so the rows of one are spread over the table
+    rows = [conversation[turn] for turn in range(args.turns) for conversation in conversations]
+
+    inline = "".join(row["prompt_text"] + row["response_text"] for row in rows).encode()
+    sent_bodies = []
+    sent_hashes = []
+    # One batch per ANALYTICS_BATCH_SIZE rows, as the writer sends them
+    batch_size = analytics.ANALYTICS_BATCH_SIZE
+    for start in range(0, len(rows), batch_size):
+        split, bodies, _ = analytics.split_bodies(rows[start:start + batch_size])
+        for digest in bodies:
+            analytics._stored_bodies[digest] = True
+        sent_bodies += bodies.values()
+        sent_hashes += ["".join(row["prompt_hashes"]) + (row["response_hash"] or "") for row in split]
+    bodies = "".join(sent_bodies).encode()
+    hashes = "".join(sent_hashes).encode()
+
+    compressor = zstandard.ZstdCompressor(level=3)
+    inline_zstd = compressed_size(inline, compressor)
+    hashed = len(bodies) + len(hashes)
+    hashed_zstd = compressed_size(bodies, compressor) + compressed_size(hashes, compressor)
+
+    print(f"{len(rows)} rows, {args.conversations} concurrent conversations of {args.turns} turns, "
+          f"{args.system_bytes} byte system prompt\n")
+    print(f"{'':<28}{'sent':>12}{'stored':>12}")
+    print(f"{'inline prompt_text':<28}{len(inline) / 1e6:10.1f} MB{inline_zstd / 1e6:10.1f} MB")
+    print(f"{'bodies by hash':<28}{hashed / 1e6:10.1f} MB{hashed_zstd / 1e6:10.1f} MB")
+    print(f"\n{len(inline) / hashed:.1f}x fewer bytes sent, {inline_zstd / hashed_zstd:.1f}x fewer stored (ZSTD(3))")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Event-loop stall from gateway database lookups: the old synchronous
+SQLAlchemy session (one shared StaticPool SQLite connection) against the
+async session (aiosqlite, WAL, pooled), and the gateways.user_id index for
+/gateway/list. A ticker coroutine measures how late the loop wakes it up
+while the lookups run, which is the delay every concurrent stream sees.
+
+    python benchmarks/db.py [--users 2000] [--gateways 20] [--requests 2000] [--concurrency 50]
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from sqlalchemy import create_engine, event, select, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from db import Base, Gateway, User, set_sqlite_pragmas
+
+TICK = 0.001
+
+
+def populate(path, users, gateways_per_user):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        # As in databases created before the index was added; run() creates it later
+        conn.execute(text("DROP INDEX ix_gateways_user_id"))
+    user_ids = [str(uuid.uuid4()) for _ in range(users)]
+    gateway_ids = []
+    with sessionmaker(bind=engine)() as db:
+        for index, user_id in enumerate(user_ids):
+            db.add(User(id=user_id, username=f"user-{index}"))
+            for _ in range(gateways_per_user):
+                gateway_id = str(uuid.uuid4())
+                gateway_ids.append(gateway_id)
+                db.add(Gateway(id=gateway_id, name="g", secret_key=str(uuid.uuid4()), user_id=user_id))
+        db.commit()
+    engine.dispose()
+    return user_ids, gateway_ids
+
+
+async def measure(name, lookup, requests, concurrency):
+    lags = []
+    running = True
+
+    async def ticker():
+        while running:
+            start = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lags.append(time.perf_counter() - start - TICK)
+
+    tick_task = asyncio.create_task(ticker())
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await lookup()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+    running = False
+    await tick_task
+
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99)] if lags else 0.0
+    print(
+        f"{name:<34} {requests / elapsed:9.0f} req/s   loop lag p50 {statistics.median(lags) * 1000:7.2f} ms"
+        f"  p99 {p99 * 1000:7.2f} ms  max {lags[-1] * 1000:7.2f} ms"
+    )
+
+
+async def run(args):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    user_ids, gateway_ids = populate(path, args.users, args.gateways)
+    print(f"{args.users} users, {len(gateway_ids)} gateways, {args.requests} requests, {args.concurrency} concurrent\n")
+
+    # Before: the synchronous session used from async endpoints
+    sync_engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SyncSession = sessionmaker(bind=sync_engine)
+
+    # After: the async session from db.py
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}", pool_size=10, max_overflow=20)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+    AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+
+    async def sync_gateway():
+        with SyncSession() as db:
+            db.query(Gateway).filter(Gateway.id == random.choice(gateway_ids)).first()
+
+    async def async_gateway():
+        async with AsyncSession() as db:
+            await db.get(Gateway, random.choice(gateway_ids))
+
+    async def sync_list():
+        with SyncSession() as db:
+            db.query(Gateway).filter(Gateway.user_id == random.choice(user_ids)).all()
+
+    async def async_list():
+        async with AsyncSession() as db:
+            (await db.scalars(select(Gateway).where(Gateway.user_id == random.choice(user_ids)))).all()
+
+    for name, lookup in (
+        ("gateway by id, sync session", sync_gateway),
+        ("gateway by id, async session", async_gateway),
+        ("/gateway/list, sync, no index", sync_list),
+        ("/gateway/list, async, no index", async_list),
+    ):
+        await measure(name, lookup, args.requests, args.concurrency)
+
+    async with async_engine.begin() as conn:
+        await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_gateways_user_id ON gateways (user_id)"))
+    await measure("/gateway/list, sync, indexed", sync_list, args.requests, args.concurrency)
+    await measure("/gateway/list, async, indexed", async_list, args.requests, args.concurrency)
+
+    await async_engine.dispose()
+    sync_engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--gateways", type=int, default=20, help="gateways per user")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
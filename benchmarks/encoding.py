@@ -0,0 +1,88 @@
+"""
+Response encoding benchmark: FastAPI's default path (jsonable_encoder +
+JSONResponse) against orjson, and the cost of gzip/zstd on top, for an
+/analytics response with include_logs=true.
+
+    python benchmarks/encoding.py [--logs 1000] [--text 2000]
+"""
+import argparse
+import gzip
+import random
+import string
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import zstandard
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+from encoding import GZIP_LEVEL, ZSTD_LEVEL, dumps
+
+
+def analytics_payload(logs, text_size):
+    words = ["".join(random.choices(string.ascii_lowercase, k=random.randint(2, 9))) for _ in range(2000)]
+
+    def text():
+        out = []
+        while sum(len(word) + 1 for word in out) < text_size:
+            out.append(random.choice(words))
+        return " ".join(out)
+
+    start = datetime(2025, 1, 1)
+    return {
+        "summary": {"total_requests": logs, "total_tokens": logs * 900, "total_cost": logs * 0.0021},
+        "models": [{"model": "gpt-4o", "requests": logs, "tokens": logs * 900}],
+        "logs": [
+            {
+                "id": f"log-{i}",
+                "timestamp": start + timedelta(seconds=i),
+                "model": "gpt-4o",
+                "provider": "openai",
+                "tokens_prompt": 600,
+                "tokens_completion": 300,
+                "cost": 0.0021,
+                "latency": 1.234,
+                "status": True,
+                "prompt_text": text(),
+                "response_text": text(),
+                "http_status_code": 200,
+                "endpoint": "/chat/completions",
+            }
+            for i in range(logs)
+        ],
+    }
+
+
+def bench(name, fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{name:<36} {elapsed * 1000:9.2f} ms  {len(result) / 1024:9.0f} KiB")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logs", type=int, default=1000)
+    parser.add_argument("--text", type=int, default=2000, help="characters of prompt and of response text per log")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    payload = analytics_payload(args.logs, args.text)
+    print(f"/analytics payload with {args.logs} logs\n")
+    current = bench("jsonable_encoder + JSONResponse", lambda: JSONResponse(jsonable_encoder(payload)).body, args.repeat)
+    fast = bench("orjson (FastJSONResponse)", lambda: dumps(payload), args.repeat)
+    bench(f"orjson + gzip level {GZIP_LEVEL}", lambda: gzip.compress(dumps(payload), GZIP_LEVEL), args.repeat)
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    bench(f"orjson + zstd level {ZSTD_LEVEL}", lambda: compressor.compress(dumps(payload)), args.repeat)
+    print(f"\nresponse bodies: {len(current)} bytes before, {len(fast)} bytes with orjson")
+
+
+if __name__ == "__main__":
+    main()
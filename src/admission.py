@@ -0,0 +1,180 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+from fastapi import HTTPException
+
+from metrics import CallbackMetric, Counter
+
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "256"))
+ADMISSION_GATEWAY_MAX_INFLIGHT = int(os.getenv("ADMISSION_GATEWAY_MAX_INFLIGHT", "64"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "1024"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+
+# Share of queued admissions each lane gets when both are waiting
+LANE_WEIGHTS = {"interactive": 4.0, "batch": 1.0}
+DEFAULT_LANE = "interactive"
+
+ADMISSION_REJECTED = Counter("gateway_admission_rejected_total", "Requests rejected by admission control", ("reason",))
+
+
+class Ticket:
+    """An admitted request's upstream slot, released once when the request is done"""
+
+    __slots__ = ("controller", "gateway_id", "queue_time", "released")
+
+    def __init__(self, controller, gateway_id, queue_time=0.0):
+        self.controller = controller
+        self.gateway_id = gateway_id
+        self.queue_time = queue_time
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self.gateway_id)
+
+
+class _Waiter:
+    __slots__ = ("gateway_id", "future")
+
+    def __init__(self, gateway_id, future):
+        self.gateway_id = gateway_id
+        self.future = future
+
+
+class AdmissionController:
+    """
+    Global and per-gateway limits on in-flight upstream calls. Requests over
+    a limit wait in a bounded queue with priority lanes; when a slot frees
+    up, lanes and then gateways are picked by weighted fair queuing, so a
+    busy gateway cannot starve the others.
+    """
+
+    def __init__(self, max_inflight=ADMISSION_MAX_INFLIGHT, gateway_max_inflight=ADMISSION_GATEWAY_MAX_INFLIGHT,
+                 max_queue=ADMISSION_MAX_QUEUE, queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.max_inflight = max_inflight
+        self.gateway_max_inflight = gateway_max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.inflight = 0
+        self.queued = 0
+        self._gateway_inflight = {}
+        # lane -> gateway_id -> deque of waiters
+        self._queues = {lane: {} for lane in LANE_WEIGHTS}
+        # Virtual times for weighted fair queuing across lanes and gateways
+        self._lane_vtime = {lane: 0.0 for lane in LANE_WEIGHTS}
+        self._gateway_vtime = {}
+        self._gateway_weight = {}
+
+    def _has_room(self, gateway_id):
+        return (self.inflight < self.max_inflight
+                and self._gateway_inflight.get(gateway_id, 0) < self.gateway_max_inflight)
+
+    def _admit(self, gateway_id):
+        self.inflight += 1
+        self._gateway_inflight[gateway_id] = self._gateway_inflight.get(gateway_id, 0) + 1
+
+    async def acquire(self, gateway, lane=None):
+        lane = lane if lane in LANE_WEIGHTS else DEFAULT_LANE
+        self._gateway_weight[gateway.id] = gateway.queue_weight or 1.0
+        if not self.queued and self._has_room(gateway.id):
+            self._admit(gateway.id)
+            return Ticket(self, gateway.id)
+
+        if self.queued >= self.max_queue:
+            ADMISSION_REJECTED.inc(reason="queue_full")
+            raise HTTPException(503, "Gateway is overloaded, try again later", headers={"Retry-After": "1"})
+
+        start = time.perf_counter()
+        waiter = _Waiter(gateway.id, asyncio.get_running_loop().create_future())
+        gateway_queues = self._queues[lane]
+        if not gateway_queues:
+            # A lane that was empty starts level with the waiting ones, instead of spending credit saved up while idle
+            busy = [self._lane_vtime[other] for other, queues in self._queues.items() if queues]
+            if busy:
+                self._lane_vtime[lane] = max(self._lane_vtime[lane], min(busy))
+        if gateway.id not in gateway_queues:
+            gateway_queues[gateway.id] = deque()
+            # Likewise for a gateway that had nothing queued
+            active = [self._gateway_vtime.get(g, 0.0) for queues in self._queues.values() for g in queues if g != gateway.id]
+            if active:
+                self._gateway_vtime[gateway.id] = max(self._gateway_vtime.get(gateway.id, 0.0), min(active))
+        gateway_queues[gateway.id].append(waiter)
+        self.queued += 1
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except BaseException as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Admitted at the same moment it gave up, hand the slot back
+                self._release(gateway.id)
+            else:
+                waiter.future.cancel()
+                self._remove(lane, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                ADMISSION_REJECTED.inc(reason="queue_timeout")
+                raise HTTPException(503, "Timed out waiting for an upstream slot", headers={"Retry-After": "1"})
+            raise
+        return Ticket(self, gateway.id, time.perf_counter() - start)
+
+    def _remove(self, lane, waiter):
+        queue = self._queues[lane].get(waiter.gateway_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return
+        self.queued -= 1
+        if not queue:
+            del self._queues[lane][waiter.gateway_id]
+
+    def _release(self, gateway_id):
+        self.inflight -= 1
+        remaining = self._gateway_inflight.get(gateway_id, 1) - 1
+        if remaining:
+            self._gateway_inflight[gateway_id] = remaining
+        else:
+            self._gateway_inflight.pop(gateway_id, None)
+        self._dispatch()
+
+    def _next(self):
+        """The (lane, gateway_id) to admit next, or None if no waiter can be admitted"""
+        best = None
+        for lane, gateway_queues in self._queues.items():
+            for gateway_id in gateway_queues:
+                if not self._has_room(gateway_id):
+                    continue
+                rank = (self._lane_vtime[lane], self._gateway_vtime.get(gateway_id, 0.0))
+                if best is None or rank < best[0]:
+                    best = (rank, lane, gateway_id)
+        return best and best[1:]
+
+    def _dispatch(self):
+        while self.queued and self.inflight < self.max_inflight:
+            picked = self._next()
+            if picked is None:
+                return
+            lane, gateway_id = picked
+            queue = self._queues[lane][gateway_id]
+            waiter = queue.popleft()
+            self.queued -= 1
+            if not queue:
+                del self._queues[lane][gateway_id]
+
+            self._lane_vtime[lane] += 1 / LANE_WEIGHTS[lane]
+            self._gateway_vtime[gateway_id] = self._gateway_vtime.get(gateway_id, 0.0) + 1 / self._gateway_weight.get(gateway_id, 1.0)
+            self._admit(gateway_id)
+            waiter.future.set_result(True)
+
+    def queued_by_lane(self):
+        return {lane: sum(len(queue) for queue in queues.values()) for lane, queues in self._queues.items()}
+
+
+admission = AdmissionController()
+
+CallbackMetric("gateway_admission_inflight", "Upstream calls admitted and not yet finished", lambda: admission.inflight)
+CallbackMetric("gateway_admission_queued", "Requests waiting for an upstream slot", admission.queued_by_lane, ("lane",))
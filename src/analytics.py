@@ -1,11 +1,23 @@
 import os
 from sqlalchemy import Column, String, Integer, Float, DateTime, Boolean
-from clickhouse_sqlalchemy import Table, engines, get_declarative_base
-from sqlalchemy import create_engine
+from clickhouse_sqlalchemy import Table, engines, get_declarative_base, types
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 import uuid
 import logging
+import time
+import asyncio
+from collections import deque
+
+import hashlib
+import random
+from cachetools import LRUCache
+
+from metrics import REQUESTS, CallbackMetric, Counter, observe_stage
+from raw_request import scan_array
+from spool import Spool
 
 Analytics_Base = get_declarative_base()
 
@@ -32,10 +44,48 @@ class RequestAnalytics(Analytics_Base):
     prompt_time = Column(Float)
     completion_time = Column(Float)
     error_message = Column(String)
-    prompt_text = Column(String)
-    response_text = Column(String)
+    # Rows written before message bodies were stored in analytics_bodies; empty since
+    prompt_text = Column(String, clickhouse_codec="ZSTD(3)")
+    response_text = Column(String, clickhouse_codec="ZSTD(3)")
+    # The messages and the response as hashes into analytics_bodies
+    prompt_hashes = Column(types.Array(types.String), clickhouse_codec="ZSTD(3)")
+    response_hash = Column(String)
     http_status_code = Column(Integer)
     endpoint = Column(String)
+    # Streaming timings, NULL for non-streaming requests
+    ttft = Column(types.Nullable(types.Float64))
+    itl_mean = Column(types.Nullable(types.Float64))
+    itl_p95 = Column(types.Nullable(types.Float64))
+    tokens_per_second = Column(types.Nullable(types.Float64))
+    # Served from another request's upstream call
+    coalesced = Column(Boolean, default=False)
+    # Answered from the response cache, saved_cost being what the upstream call would have cost
+    cache_hit = Column(Boolean, default=False)
+    saved_cost = Column(types.Nullable(types.Float64))
+    # A backup request was fired; hedge_won when it answered before the first one
+    hedged = Column(Boolean, default=False)
+    hedge_won = Column(Boolean, default=False)
+    hedge_wasted_tokens = Column(Integer, default=0)
+    # Why the bodies were kept (error, slow, cost, sampled), empty when they were dropped or there were none.
+    # Rows with bodies stand for sample_weight requests, 0 when the bodies were dropped
+    capture_reason = Column(types.LowCardinality(types.String), server_default=text("''"))
+    sample_weight = Column(types.Float64, server_default=text("1"))
+
+
+class AnalyticsBody(Analytics_Base):
+    """
+    Message and response bodies by content hash. A system prompt or a turn
+    of history repeated on every request of a conversation is stored once;
+    duplicate inserts are merged away by the engine.
+    """
+    __tablename__ = "analytics_bodies"
+    __table_args__ = (
+        engines.ReplacingMergeTree(order_by=['hash']),
+    )
+
+    hash = Column(String, primary_key=True)
+    body = Column(String, clickhouse_codec="ZSTD(3)")
+    first_seen = Column(DateTime, default=datetime.utcnow)
 
 
 # Initialize engine only if ClickHouse is available
@@ -43,6 +93,28 @@ import socket
 from contextlib import closing
 
 CLICKHOUSE_URL = os.getenv("CLICKHOUSE_URL")
+# Rows written per insert, and the longest a row waits in memory before it is written
+ANALYTICS_BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", "1000"))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "1.0"))
+# Most rows held in memory while ClickHouse is slow; then "oldest" drops the oldest queued row, "newest" the new one
+ANALYTICS_QUEUE_SIZE = int(os.getenv("ANALYTICS_QUEUE_SIZE", "50000"))
+ANALYTICS_DROP_POLICY = os.getenv("ANALYTICS_DROP_POLICY", "oldest")
+# Seconds between attempts to reach ClickHouse while it is down
+ANALYTICS_RETRY_INTERVAL = float(os.getenv("ANALYTICS_RETRY_INTERVAL", "5"))
+# Local directory rows are kept in while ClickHouse is down or slow, empty to drop them instead
+ANALYTICS_SPOOL_DIR = os.getenv("ANALYTICS_SPOOL_DIR", "analytics-spool")
+ANALYTICS_SPOOL_SEGMENT_BYTES = int(os.getenv("ANALYTICS_SPOOL_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+# Past this the oldest segments are deleted
+ANALYTICS_SPOOL_MAX_BYTES = int(os.getenv("ANALYTICS_SPOOL_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Rows per insert when the spool is replayed
+ANALYTICS_REPLAY_BATCH_SIZE = int(os.getenv("ANALYTICS_REPLAY_BATCH_SIZE", "10000"))
+# Body hashes remembered as already stored, so repeated messages are not sent to ClickHouse again
+ANALYTICS_BODY_CACHE_SIZE = int(os.getenv("ANALYTICS_BODY_CACHE_SIZE", "100000"))
+# Which requests keep their prompt and response bodies, for gateways without their own capture settings:
+# errors always, requests slower (seconds) or costlier (USD) than the thresholds, and this share of the rest
+ANALYTICS_CAPTURE_SAMPLE_RATE = float(os.getenv("ANALYTICS_CAPTURE_SAMPLE_RATE", "1.0"))
+ANALYTICS_CAPTURE_LATENCY_THRESHOLD = float(os.getenv("ANALYTICS_CAPTURE_LATENCY_THRESHOLD") or "inf")
+ANALYTICS_CAPTURE_COST_THRESHOLD = float(os.getenv("ANALYTICS_CAPTURE_COST_THRESHOLD") or "inf")
 
     
 def is_clickhouse_available():
@@ -82,41 +154,417 @@ else:
     analytics_engine = None
     _Session = None
 
+def migrate_analytics_schema():
+    """Add columns introduced after the table was first created"""
+    if not analytics_engine:
+        return
+    table = RequestAnalytics.__table__
+    with analytics_engine.connect() as conn:
+        for column in table.columns:
+            ddl = CreateColumn(column).compile(dialect=analytics_engine.dialect)
+            conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {ddl}"))
+            if column.dialect_options["clickhouse"]["codec"]:
+                # Columns created before they had a codec; only parts written or merged from now on are recompressed
+                conn.execute(text(f"ALTER TABLE {table.name} MODIFY COLUMN {ddl}"))
+
+
+ANALYTICS_ROWS = Counter("gateway_analytics_rows_total", "Analytics rows by outcome", ("result",))
+ANALYTICS_CAPTURES = Counter(
+    "gateway_analytics_captures_total",
+    "Requests whose prompt and response bodies were kept or dropped, by reason",
+    ("result", "reason"),
+)
+ANALYTICS_BODY_BYTES = Counter(
+    "gateway_analytics_body_bytes_total",
+    "Characters of prompt and response bodies, sent to ClickHouse or already stored",
+    ("result",),
+)
+
+_COLUMNS = [column.name for column in RequestAnalytics.__table__.columns]
+_BODY_COLUMNS = [column.name for column in AnalyticsBody.__table__.columns]
+_schema_ready = False
+
+
+def ensure_analytics_schema():
+    """Create the table and add new columns, once per process, on the first connection that works"""
+    global _schema_ready
+    if not _schema_ready:
+        Analytics_Base.metadata.create_all(analytics_engine)
+        migrate_analytics_schema()
+        _schema_ready = True
+
+
+# Hashes of bodies known to be in analytics_bodies; only the writer thread uses it
+_stored_bodies = LRUCache(maxsize=ANALYTICS_BODY_CACHE_SIZE)
+
+
+def body_hash(body):
+    return hashlib.blake2b(body.encode(), digest_size=16).hexdigest()
+
+
+def split_bodies(rows):
+    """
+    The rows with their prompt and response replaced by hashes, the
+    {hash: body} that are not known to be stored yet, and the size of all
+    the bodies referenced. Each message of the prompt is its own body, kept
+    as the caller's JSON.
+    """
+    split = []
+    bodies = {}
+    referenced = 0
+    for row in rows:
+        prompt_text = row.get("prompt_text")
+        response_text = row.get("response_text")
+        if not prompt_text and not response_text:
+            split.append({**row, "prompt_hashes": row.get("prompt_hashes") or [], "response_hash": row.get("response_hash")})
+            continue
+        try:
+            messages = scan_array(prompt_text) if prompt_text else []
+        except ValueError:
+            # Not a messages array, kept in the row as it is
+            messages = None
+        prompt_hashes = []
+        for message in messages or ():
+            digest = body_hash(message)
+            prompt_hashes.append(digest)
+            bodies[digest] = message
+            referenced += len(message)
+        response_hash = None
+        if response_text:
+            response_hash = body_hash(response_text)
+            bodies[response_hash] = response_text
+            referenced += len(response_text)
+        split.append({**row, "prompt_text": prompt_text if messages is None else "", "response_text": "",
+                      "prompt_hashes": prompt_hashes, "response_hash": response_hash})
+    return split, {digest: body for digest, body in bodies.items() if digest not in _stored_bodies}, referenced
+
+
+def _insert(conn, table, columns, rows):
+    if analytics_engine.dialect.driver == "native":
+        # The clickhouse-driver client under the connection: one list per column, sent as native blocks
+        client = conn.connection.dbapi_connection.transport
+        client.execute(
+            f"INSERT INTO {table.name} ({', '.join(columns)}) VALUES",
+            [[row[name] for row in rows] for name in columns],
+            columnar=True,
+            settings={"input_format_null_as_default": True},
+        )
+    else:
+        conn.execute(table.insert(), rows)
+
+
+def insert_rows(rows):
+    """Bulk insert row dicts, without building ORM objects, after the bodies they reference"""
+    rows, bodies, referenced = split_bodies(rows)
+    with analytics_engine.connect() as conn:
+        if bodies:
+            now = datetime.utcnow()
+            body_rows = [{"hash": digest, "body": body, "first_seen": now} for digest, body in bodies.items()]
+            _insert(conn, AnalyticsBody.__table__, _BODY_COLUMNS, body_rows)
+            for digest in bodies:
+                _stored_bodies[digest] = True
+        _insert(conn, RequestAnalytics.__table__, _COLUMNS, rows)
+    stored = sum(len(body) for body in bodies.values())
+    ANALYTICS_BODY_BYTES.inc(stored, result="stored")
+    ANALYTICS_BODY_BYTES.inc(referenced - stored, result="deduplicated")
+
+
+def load_bodies(session, hashes):
+    """{hash: body} for the given hashes"""
+    table = AnalyticsBody.__table__
+    hashes = list(hashes)
+    bodies = {}
+    for start in range(0, len(hashes), 1000):
+        query = select(table.c.hash, table.c.body).where(table.c.hash.in_(hashes[start:start + 1000]))
+        bodies.update(session.execute(query).all())
+    return bodies
+
+
+def prompt_from_bodies(prompt_hashes, bodies):
+    """The messages JSON of a row, from its message hashes"""
+    return "[" + ",".join(bodies.get(digest, "null") for digest in prompt_hashes) + "]"
+
+
+def existing_ids(rows):
+    """Ids of rows that are already in ClickHouse"""
+    table = RequestAnalytics.__table__
+    timestamps = [row["timestamp"] for row in rows]
+    query = select(table.c.id).where(
+        # Narrows the scan to the parts covering these rows, the table is ordered by timestamp
+        table.c.timestamp.between(min(timestamps), max(timestamps)),
+        table.c.id.in_([row["id"] for row in rows]),
+    )
+    with analytics_engine.connect() as conn:
+        return set(conn.execute(query).scalars())
+
+
+class AnalyticsWriter:
+    """
+    Buffers analytics rows in memory and inserts them in bulk from a
+    background task, every ANALYTICS_BATCH_SIZE rows or ANALYTICS_FLUSH_INTERVAL
+    seconds, so requests never wait on ClickHouse. Inserts go out in columnar
+    native blocks with the native driver, or as one multi-row INSERT over
+    HTTP.
+
+    With a spool, a batch that cannot be inserted is written to disk
+    instead, and so is every batch after it until ClickHouse is tried
+    again ANALYTICS_RETRY_INTERVAL seconds later; once an insert works the
+    spool is replayed in bulk, skipping ids ClickHouse already has. Rows
+    past ANALYTICS_QUEUE_SIZE are moved to the spool, or without one the
+    ANALYTICS_DROP_POLICY row (the oldest queued one, or the new one) is
+    dropped and counted.
+    """
+
+    def __init__(self, batch_size=ANALYTICS_BATCH_SIZE, interval=ANALYTICS_FLUSH_INTERVAL,
+                 max_rows=ANALYTICS_QUEUE_SIZE, drop_policy=ANALYTICS_DROP_POLICY, spool=None):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_rows = max_rows
+        self.drop_policy = drop_policy
+        self.spool = spool
+        # Whether the last insert worked, and when to try ClickHouse again if not
+        self.healthy = True
+        self._retry_at = 0.0
+        self._rows = deque()
+        self._wakeup = None
+        self._task = None
+        self._spills = set()
+        self._closing = False
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, row):
+        if len(self._rows) >= self.max_rows:
+            if self.spool is not None and self._task is not None:
+                # ClickHouse is not keeping up, the oldest rows go to disk
+                self._spill([self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))])
+            else:
+                ANALYTICS_ROWS.inc(result="dropped")
+                if self.drop_policy == "newest":
+                    return
+                self._rows.popleft()
+        self._rows.append(row)
+        if self._task is None:
+            self.start()
+        if len(self._rows) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is not None or self._closing:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop yet, the rows wait for start() at startup
+            return
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            if self.spool is not None and len(self.spool) and self._due() and not self._closing:
+                await asyncio.to_thread(self._replay)
+
+    async def flush(self):
+        """Write every queued row, one batch at a time"""
+        while self._rows:
+            batch = [self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))]
+            write_start = time.perf_counter()
+            await asyncio.to_thread(self._write, batch)
+            observe_stage("analytics_write", time.perf_counter() - write_start)
+
+    def _due(self):
+        return self.healthy or time.monotonic() >= self._retry_at
+
+    def _failed(self, message):
+        self.healthy = False
+        self._retry_at = time.monotonic() + ANALYTICS_RETRY_INTERVAL
+        logging.error(message)
+
+    def _recovered(self):
+        if not self.healthy:
+            print("ClickHouse is back, analytics are written again")
+        self.healthy = True
+
+    def _write(self, rows):
+        if self._due():
+            try:
+                ensure_analytics_schema()
+                insert_rows(rows)
+            except Exception as e:
+                self._failed(f"Failed to save {len(rows)} analytics rows to ClickHouse: {e}")
+            else:
+                self._recovered()
+                ANALYTICS_ROWS.inc(len(rows), result="written")
+                return
+        if self.spool is None:
+            ANALYTICS_ROWS.inc(len(rows), result="failed")
+        else:
+            self._to_spool(rows)
+
+    def _spill(self, rows):
+        task = asyncio.get_running_loop().create_task(asyncio.to_thread(self._to_spool, rows))
+        self._spills.add(task)
+        task.add_done_callback(self._spills.discard)
+
+    def _to_spool(self, rows):
+        try:
+            dropped = self.spool.append(rows)
+        except (OSError, TypeError) as e:
+            ANALYTICS_ROWS.inc(len(rows), result="failed")
+            logging.error(f"Failed to spool {len(rows)} analytics rows: {e}")
+            return
+        ANALYTICS_ROWS.inc(len(rows), result="spooled")
+        if dropped:
+            # The spool is over ANALYTICS_SPOOL_MAX_BYTES, its oldest segment went
+            ANALYTICS_ROWS.inc(dropped, result="dropped")
+
+    def _replay(self):
+        """Insert the spooled rows, oldest segment first, deleting each segment once it is in"""
+        for path in self.spool.seal():
+            batch = {}
+            try:
+                ensure_analytics_schema()
+                for record in self.spool.read(path):
+                    # Rows spooled before the capture columns existed kept their bodies
+                    record = {"capture_reason": "", "sample_weight": 1.0, **record}
+                    record["timestamp"] = datetime.fromisoformat(record["timestamp"])
+                    batch[record["id"]] = record
+                    if len(batch) >= ANALYTICS_REPLAY_BATCH_SIZE:
+                        self._replay_batch(batch)
+                        batch = {}
+                if batch:
+                    self._replay_batch(batch)
+            except Exception as e:
+                # The whole segment is replayed next time, rows already in are skipped then
+                self._failed(f"Failed to replay spooled analytics from {path}: {e}")
+                return
+            self._recovered()
+            self.spool.remove(path)
+
+    def _replay_batch(self, batch):
+        existing = existing_ids(batch.values())
+        rows = [row for row_id, row in batch.items() if row_id not in existing]
+        if rows:
+            insert_rows(rows)
+        ANALYTICS_ROWS.inc(len(rows), result="replayed")
+        ANALYTICS_ROWS.inc(len(existing), result="duplicate")
+
+    async def aclose(self):
+        """Stop the background task and write what is still queued, to the spool if ClickHouse is down"""
+        self._closing = True
+        if self._task is not None:
+            # Lets an insert in progress finish
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        if self._spills:
+            await asyncio.gather(*self._spills)
+
+
+analytics_writer = AnalyticsWriter(
+    spool=Spool(ANALYTICS_SPOOL_DIR, ANALYTICS_SPOOL_SEGMENT_BYTES, ANALYTICS_SPOOL_MAX_BYTES)
+    if analytics_engine and ANALYTICS_SPOOL_DIR else None
+)
+
+CallbackMetric("gateway_analytics_queue_depth", "Analytics rows waiting to be written", lambda: len(analytics_writer))
+CallbackMetric(
+    "gateway_analytics_spool_bytes",
+    "Analytics rows on disk waiting for ClickHouse, in bytes",
+    lambda: analytics_writer.spool.size() if analytics_writer.spool is not None else 0,
+)
+CallbackMetric("gateway_analytics_sink_up", "Whether the last ClickHouse insert worked", lambda: int(analytics_writer.healthy))
+
+
+def capture_decision(gateway, status, latency, cost):
+    """
+    Whether a finished request keeps its bodies: the reason they are kept,
+    or None, and the row's sample weight. Uses the gateway's capture
+    settings, and the ANALYTICS_CAPTURE_* defaults for those it leaves unset.
+    """
+    def setting(name, default):
+        value = getattr(gateway, name, None)
+        return default if value is None else value
+
+    if not status:
+        return "error", 1.0
+    if latency is not None and latency >= setting("capture_latency_threshold", ANALYTICS_CAPTURE_LATENCY_THRESHOLD):
+        return "slow", 1.0
+    if cost and cost >= setting("capture_cost_threshold", ANALYTICS_CAPTURE_COST_THRESHOLD):
+        return "cost", 1.0
+    rate = setting("capture_sample_rate", ANALYTICS_CAPTURE_SAMPLE_RATE)
+    if rate > 0 and (rate >= 1 or random.random() < rate):
+        return "sampled", 1.0 / min(rate, 1.0)
+    return None, 0.0
+
+
 def save_analytics(chat_id=None, gateway_id=None, model=None, provider=None, tokens_prompt=0, tokens_completion=0,
                    request_type=None, status=False, cost=0.0, latency=None, queue_time=None,
                    prompt_time=None, completion_time=None, error_message=None, prompt_text=None,
-                   response_text=None, http_status_code=None, endpoint=None):
-    global analytics_engine, _Session
-    if not analytics_engine or not _Session:
+                   response_text=None, http_status_code=None, endpoint=None, ttft=None, itl_mean=None,
+                   itl_p95=None, tokens_per_second=None, coalesced=False, cache_hit=False, saved_cost=None,
+                   hedged=False, hedge_won=False, hedge_wasted_tokens=0, gateway=None):
+    """
+    Count the request and queue its analytics row for the background writer.
+    gateway is the gateway that served the request, for its capture settings.
+    """
+    REQUESTS.inc(provider=provider, model=model, gateway=gateway_id, request_type=request_type,
+                 status="success" if status else "error")
+    if not analytics_engine:
         # Silently return if ClickHouse is not available
         print("ClickHouse not available, skipping analytics save")
         return
-    
-    try:
-        session = _Session()
-        record = RequestAnalytics(
-            response_id=chat_id,
-            gateway_id=gateway_id,
-            model=model,
-            provider=provider,
-            tokens_prompt=tokens_prompt,
-            tokens_completion=tokens_completion,
-            tokens_total=tokens_prompt + tokens_completion,
-            request_type=request_type,
-            status=status,
-            cost=cost,
-            latency=latency,
-            queue_time=queue_time,
-            prompt_time=prompt_time,
-            completion_time=completion_time,
-            error_message=error_message,
-            prompt_text=prompt_text,
-            response_text=response_text,
-            http_status_code=http_status_code,
-            endpoint=endpoint
-        )
-        session.add(record)
-        session.commit()
-        session.close()
-    except Exception as e:
-        logging.error(f"Failed to save analytics to ClickHouse: {e}")
+
+    capture_reason, sample_weight = "", 1.0
+    if prompt_text or response_text:
+        # Decided now that the status, latency and cost are known; the metrics row is written either way
+        capture_reason, sample_weight = capture_decision(gateway, status, latency, cost)
+        if capture_reason is None:
+            ANALYTICS_CAPTURES.inc(result="dropped", reason="sampled_out")
+            capture_reason, prompt_text, response_text = "", None, None
+        else:
+            ANALYTICS_CAPTURES.inc(result="kept", reason=capture_reason)
+
+    analytics_writer.add({
+        "id": str(uuid.uuid4()),
+        "response_id": chat_id,
+        "timestamp": datetime.utcnow(),
+        "gateway_id": gateway_id,
+        "model": model,
+        "provider": provider,
+        "tokens_prompt": tokens_prompt,
+        "tokens_completion": tokens_completion,
+        "tokens_total": tokens_prompt + tokens_completion,
+        "request_type": request_type,
+        "status": status,
+        "cost": cost,
+        "latency": latency,
+        "queue_time": queue_time,
+        "prompt_time": prompt_time,
+        "completion_time": completion_time,
+        "error_message": error_message,
+        "prompt_text": prompt_text,
+        "response_text": response_text,
+        "http_status_code": http_status_code,
+        "endpoint": endpoint,
+        "ttft": ttft,
+        "itl_mean": itl_mean,
+        "itl_p95": itl_p95,
+        "tokens_per_second": tokens_per_second,
+        "coalesced": coalesced,
+        "cache_hit": cache_hit,
+        "saved_cost": saved_cost,
+        "hedged": hedged,
+        "hedge_won": hedge_won,
+        "hedge_wasted_tokens": hedge_wasted_tokens,
+        "capture_reason": capture_reason,
+        "sample_weight": sample_weight,
+    })
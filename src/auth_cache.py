@@ -0,0 +1,154 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import threading
+
+import httpx
+from cachetools import TTLCache
+
+from db import Gateway, User
+from metrics import CACHE_REQUESTS
+
+# Seconds a gateway or user lookup is served from memory; bounds how stale an
+# entry can get on a worker that missed an invalidation
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "30"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+# Base URLs of the other workers or nodes, told to drop entries when a gateway changes here
+AUTH_CACHE_PEERS = [peer.strip().rstrip("/") for peer in os.getenv("AUTH_CACHE_PEERS", "").split(",") if peer.strip()]
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Cached for gateway ids that do not exist, so unknown ids do not reach the database either
+_MISSING = object()
+
+
+def _digest(secret):
+    return hashlib.sha256(secret.encode()).digest()
+
+
+class CachedGateway:
+    """A read-only copy of a gateway row, with the secret kept only as a digest"""
+
+    def __init__(self, row):
+        for column in Gateway.__table__.columns:
+            if column.key != "secret_key":
+                setattr(self, column.key, getattr(row, column.key))
+        self.secret_digest = _digest(row.secret_key or "")
+
+    def check_secret(self, secret):
+        # Constant time, whatever the secret and however much of it matches
+        return hmac.compare_digest(_digest(secret or ""), self.secret_digest)
+
+
+class CachedUser:
+    __slots__ = ("id", "username")
+
+    def __init__(self, row):
+        self.id = row.id
+        self.username = row.username
+
+
+class AuthCache:
+    """
+    TTL caches of gateway id -> CachedGateway and user id -> CachedUser in
+    front of the database. Endpoints that change a gateway invalidate its
+    entry here, and the listeners pass the invalidation on, by default to
+    AUTH_CACHE_PEERS; anything missed expires after AUTH_CACHE_TTL.
+    """
+
+    def __init__(self, ttl=AUTH_CACHE_TTL, maxsize=AUTH_CACHE_SIZE):
+        self._gateways = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._users = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Sync endpoints run in the threadpool
+        self._lock = threading.Lock()
+        # Bumped by every invalidation
+        self._generation = 0
+        self.listeners = []
+
+    async def gateway(self, gateway_id, db):
+        """The gateway, or None when there is no such gateway"""
+        if not gateway_id:
+            return None
+        with self._lock:
+            entry = self._gateways.get(gateway_id)
+            generation = self._generation
+        CACHE_REQUESTS.inc(cache="gateway_auth", result="miss" if entry is None else "hit")
+        if entry is None:
+            row = await db.get(Gateway, gateway_id)
+            entry = CachedGateway(row) if row else _MISSING
+            self._store(self._gateways, gateway_id, entry, generation)
+        return None if entry is _MISSING else entry
+
+    async def user(self, user_id, db):
+        """The user, or None; unknown user ids are not cached"""
+        with self._lock:
+            user = self._users.get(user_id)
+            generation = self._generation
+        CACHE_REQUESTS.inc(cache="user_auth", result="miss" if user is None else "hit")
+        if user is None:
+            row = await db.get(User, user_id)
+            if row is None:
+                return None
+            user = CachedUser(row)
+            self._store(self._users, user_id, user, generation)
+        return user
+
+    def _store(self, cache, key, entry, generation):
+        with self._lock:
+            # A row read before an invalidation may already be stale
+            if generation == self._generation:
+                cache[key] = entry
+
+    def invalidate(self, gateways=(), users=(), publish=True):
+        with self._lock:
+            self._generation += 1
+            for gateway_id in gateways:
+                self._gateways.pop(gateway_id, None)
+            for user_id in users:
+                self._users.pop(user_id, None)
+        if publish:
+            for listener in self.listeners:
+                try:
+                    listener(list(gateways), list(users))
+                except Exception as e:
+                    print(f"Auth cache invalidation listener failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._gateways.clear()
+            self._users.clear()
+
+
+auth_cache = AuthCache()
+
+_peer_tasks = set()
+
+
+async def _notify_peers(gateways, users):
+    async with httpx.AsyncClient(timeout=5) as client:
+        for peer in AUTH_CACHE_PEERS:
+            try:
+                await client.post(
+                    f"{peer}/admin/auth-cache/invalidate",
+                    json={"gateways": gateways, "users": users},
+                    headers={"x-admin-token": ADMIN_TOKEN or ""},
+                )
+            except httpx.HTTPError as e:
+                print(f"Auth cache invalidation to {peer} failed: {e}")
+
+
+def notify_peers(gateways, users):
+    """Invalidation listener that forwards to the /admin/auth-cache/invalidate endpoint of each peer"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # No event loop in this thread, the peers' entries expire on their own
+        return
+    task = loop.create_task(_notify_peers(gateways, users))
+    _peer_tasks.add(task)
+    task.add_done_callback(_peer_tasks.discard)
+
+
+if AUTH_CACHE_PEERS:
+    auth_cache.listeners.append(notify_peers)
@@ -0,0 +1,527 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from admission import admission
+from analytics import save_analytics
+from circuit import is_retryable
+from clients import client_pool
+from db import SessionLocal
+from auth_cache import auth_cache
+from key_pool import key_pools
+from metrics import CallbackMetric
+from rate_limit import TokenBucket, rate_limiter, estimate_tokens
+from raw_request import RawChatRequest
+from upstream import create_completion
+from utils import resolve_route, resolve_single_route, extract_status_code_from_error
+
+BATCH_DIR = os.getenv("BATCH_DIR", "./batches")
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "3"))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(100 * 1024 * 1024)))
+# Requests per minute batch workers send to each provider, 0 for no shaping
+BATCH_DEFAULT_RPM = int(os.getenv("BATCH_DEFAULT_RPM", "0"))
+BATCH_PROVIDER_RPM = json.loads(os.getenv("BATCH_PROVIDER_RPM", "{}"))
+BATCH_NATIVE_POLL_SECONDS = float(os.getenv("BATCH_NATIVE_POLL_SECONDS", "60"))
+# Progress is written to disk every this many finished lines
+BATCH_CHECKPOINT_EVERY = 20
+
+# Providers with a native batch API, and the discount it gets on the list price
+NATIVE_BATCH_DISCOUNT = {"openai": 0.5}
+
+ACTIVE = ("queued", "in_progress")
+NATIVE_DONE = ("completed", "failed", "expired", "cancelled")
+
+
+class ProviderShaper:
+    """Spreads batch requests to each provider out to its configured RPM"""
+
+    def __init__(self, default_rpm=BATCH_DEFAULT_RPM, provider_rpm=BATCH_PROVIDER_RPM):
+        self.default_rpm = default_rpm
+        self.provider_rpm = provider_rpm
+        self._buckets = {}
+
+    async def wait(self, provider):
+        rpm = self.provider_rpm.get(provider, self.default_rpm)
+        if not rpm:
+            return
+        bucket = self._buckets.get(provider)
+        if bucket is None or bucket.capacity != rpm:
+            # Start empty, so a batch does not open with a burst of a whole minute's requests
+            bucket = self._buckets[provider] = TokenBucket(rpm)
+            bucket.tokens = 1.0
+        while True:
+            wait = bucket.take(1, time.monotonic())
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+def parse_batch_lines(raw):
+    """
+    Lines of a batch file, either in the OpenAI batch format
+    ({"custom_id", "method", "url", "body"}) or bare chat completion bodies.
+    Returns a list of {"custom_id", "body"}.
+    """
+    items = []
+    seen = set()
+    for number, line in enumerate(raw.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            raise HTTPException(400, f"Line {number} is not valid JSON")
+        if not isinstance(entry, dict):
+            raise HTTPException(400, f"Line {number} is not a JSON object")
+        body = entry["body"] if isinstance(entry.get("body"), dict) else entry
+        if entry.get("url", "/v1/chat/completions").rstrip("/").split("/")[-2:] != ["chat", "completions"]:
+            raise HTTPException(400, f"Line {number} is not a chat completion request")
+        custom_id = str(entry.get("custom_id") or f"line-{number}")
+        if custom_id in seen:
+            raise HTTPException(400, f"Line {number} repeats custom_id {custom_id}")
+        try:
+            request = RawChatRequest(json.dumps(body))
+        except HTTPException as e:
+            raise HTTPException(400, f"Line {number} is not a valid chat completion request: {e.detail}")
+        seen.add(custom_id)
+        items.append({"custom_id": custom_id, "body": dict(body, model=request.model)})
+    if not items:
+        raise HTTPException(400, "The batch file has no requests")
+    return items
+
+
+def _output_line(custom_id, status_code, body=None, error=None):
+    return {
+        "id": f"batch_req_{uuid.uuid4().hex}",
+        "custom_id": custom_id,
+        "response": {"status_code": status_code, "body": body} if body is not None else None,
+        "error": error,
+    }
+
+
+class BatchManager:
+    """
+    Runs uploaded JSONL batches in the background. Each batch lives in its
+    own directory under BATCH_DIR with its input, the output written so far
+    and a state file, so a restarted gateway resumes where it stopped.
+    """
+
+    def __init__(self, root=BATCH_DIR, concurrency=BATCH_CONCURRENCY, max_retries=BATCH_MAX_RETRIES):
+        self.root = root
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.shaper = ProviderShaper()
+        self._states = {}
+        self._tasks = {}
+        # Callers' API keys, only kept in memory while their batch runs
+        self._api_keys = {}
+
+    def _path(self, batch_id, name):
+        return os.path.join(self.root, batch_id, name)
+
+    def _save_state(self, state):
+        path = self._path(state["id"], "batch.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    def _load_state(self, batch_id):
+        try:
+            with open(self._path(batch_id, "batch.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, batch_id, gateway_id):
+        if not batch_id.replace("-", "").isalnum():
+            return None
+        state = self._states.get(batch_id) or self._load_state(batch_id)
+        if state is None or state["gateway_id"] != gateway_id:
+            return None
+        return state
+
+    def list(self, gateway_id):
+        batches = []
+        if os.path.isdir(self.root):
+            for batch_id in os.listdir(self.root):
+                state = self.get(batch_id, gateway_id)
+                if state:
+                    batches.append(state)
+        return sorted(batches, key=lambda state: state["created_at"], reverse=True)
+
+    def output_path(self, batch_id):
+        return self._path(batch_id, "output.jsonl")
+
+    async def create(self, gateway, raw, api_key=None, native=False):
+        if len(raw) > BATCH_MAX_BYTES:
+            raise HTTPException(413, f"Batch files are limited to {BATCH_MAX_BYTES} bytes")
+        items = parse_batch_lines(raw)
+
+        native_provider = None
+        if native:
+            providers = {resolve_route(item["body"]["model"], api_key)[0].provider for item in items}
+            native_provider = providers.pop() if len(providers) == 1 else None
+            if native_provider not in NATIVE_BATCH_DISCOUNT:
+                raise HTTPException(400, "Native batches need every line to use one provider with a batch API "
+                                         f"({', '.join(NATIVE_BATCH_DISCOUNT)})")
+
+        batch_id = str(uuid.uuid4())
+        os.makedirs(os.path.join(self.root, batch_id))
+        await asyncio.to_thread(self._write_input, batch_id, items)
+        state = {
+            "id": batch_id,
+            "object": "batch",
+            "gateway_id": gateway.id,
+            "status": "queued",
+            "mode": "native" if native else "gateway",
+            "native_provider": native_provider,
+            "native_batch_id": None,
+            "total": len(items),
+            "completed": 0,
+            "failed": 0,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+        }
+        self._save_state(state)
+        self._start(state, api_key)
+        return state
+
+    def _write_input(self, batch_id, items):
+        with open(self._path(batch_id, "input.jsonl"), "w") as f:
+            for item in items:
+                f.write(json.dumps(item) + "\n")
+
+    def _read_input(self, batch_id):
+        with open(self._path(batch_id, "input.jsonl")) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _start(self, state, api_key=None):
+        batch_id = state["id"]
+        self._states[batch_id] = state
+        self._api_keys[batch_id] = api_key
+        run = self._run_native if state["mode"] == "native" else self._run
+        task = self._tasks[batch_id] = asyncio.create_task(run(state, api_key))
+
+        def done(_):
+            self._tasks.pop(batch_id, None)
+            self._api_keys.pop(batch_id, None)
+        task.add_done_callback(done)
+
+    def resume(self):
+        """Restart the batches that were running when the gateway stopped"""
+        if not os.path.isdir(self.root):
+            return
+        for batch_id in os.listdir(self.root):
+            state = self._load_state(batch_id)
+            if state and state["status"] in ACTIVE and batch_id not in self._tasks:
+                print(f"Resuming batch {batch_id}")
+                # The caller's API key is never written to disk, resumed batches use the provider key pools
+                self._start(state)
+
+    async def cancel(self, batch_id, gateway_id):
+        state = self.get(batch_id, gateway_id)
+        if state is None:
+            return None
+        if state["status"] not in ACTIVE:
+            return state
+        if state["native_batch_id"]:
+            try:
+                async with self._native_client(state) as client:
+                    await client.batches.cancel(state["native_batch_id"])
+            except Exception as e:
+                print(f"Failed to cancel native batch {state['native_batch_id']}: {e}")
+        task = self._tasks.get(batch_id)
+        if task is not None:
+            task.cancel()
+        self._finish(state, "cancelled")
+        return state
+
+    async def aclose(self):
+        # Running batches keep their status and are resumed on the next start
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _finish(self, state, status, error=None):
+        state["status"] = status
+        state["error"] = error
+        state["finished_at"] = time.time()
+        self._save_state(state)
+
+    def _done_ids(self, batch_id):
+        """
+        custom_ids already in the output, the checkpoint a resumed batch
+        starts from. A line cut short by a crash is dropped and retried.
+        """
+        done = {}
+        path = self.output_path(batch_id)
+        if not os.path.exists(path):
+            return done
+        with open(path, "r+b") as f:
+            complete = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                done[entry["custom_id"]] = entry.get("error") is None
+                complete += len(line)
+            f.truncate(complete)
+        return done
+
+    async def _run(self, state, api_key):
+        batch_id = state["id"]
+        try:
+            async with SessionLocal() as db:
+                gateway = await auth_cache.gateway(state["gateway_id"], db)
+            if gateway is None:
+                self._finish(state, "failed", "Gateway no longer exists")
+                return
+
+            items = await asyncio.to_thread(self._read_input, batch_id)
+            done = self._done_ids(batch_id)
+            state["completed"] = sum(done.values())
+            state["failed"] = len(done) - state["completed"]
+            state["status"] = "in_progress"
+            state["started_at"] = state["started_at"] or time.time()
+            self._save_state(state)
+
+            queue = asyncio.Queue()
+            for item in items:
+                if item["custom_id"] not in done:
+                    queue.put_nowait(item)
+
+            with open(self.output_path(batch_id), "a") as output:
+                async def worker():
+                    while not queue.empty():
+                        item = queue.get_nowait()
+                        try:
+                            line = await self._process(gateway, item, api_key)
+                        except Exception as e:
+                            # One bad line fails on its own, the rest of the batch carries on
+                            print(f"Batch {batch_id} line {item['custom_id']} failed: {e}")
+                            line = _output_line(item["custom_id"], 500, error={"code": "internal_error", "message": str(e)})
+                        output.write(json.dumps(line) + "\n")
+                        output.flush()
+                        state["completed" if line["error"] is None else "failed"] += 1
+                        if (state["completed"] + state["failed"]) % BATCH_CHECKPOINT_EVERY == 0:
+                            self._save_state(state)
+
+                workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, queue.qsize()))]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    # Stop the others before the output is closed, if one of them could not write it
+                    for task in workers:
+                        task.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+            self._finish(state, "completed")
+        except asyncio.CancelledError:
+            if state["status"] in ACTIVE:
+                self._save_state(state)
+            raise
+        except Exception as e:
+            print(f"Batch {batch_id} failed: {e}")
+            self._finish(state, "failed", str(e))
+
+    async def _process(self, gateway, item, api_key):
+        """Run one batch line, retrying provider failures, and return its output line"""
+        custom_id, body = item["custom_id"], item["body"]
+        request = RawChatRequest(json.dumps(body))
+        try:
+            routes = resolve_route(request.model, api_key)
+        except HTTPException as e:
+            return _output_line(custom_id, e.status_code, error={"code": "invalid_model", "message": e.detail})
+
+        attempt = 0
+        while True:
+            await self.shaper.wait(routes[0].provider)
+            # Batches share the gateway's limits with its live traffic, but wait instead of failing
+            try:
+                reservation = rate_limiter.acquire(gateway, estimate_tokens(request.prompt_text, request.max_tokens))
+            except HTTPException as e:
+                await asyncio.sleep(float(e.headers["Retry-After"]))
+                continue
+            try:
+                ticket = await admission.acquire(gateway, "batch")
+            except HTTPException as e:
+                reservation.settle(0)
+                await asyncio.sleep(float(e.headers["Retry-After"]))
+                continue
+
+            start_time = time.time()
+            try:
+                (route, completion), _ = await create_completion(routes, request)
+            except Exception as e:
+                reservation.settle(0)
+                if is_retryable(e) and attempt < self.max_retries:
+                    attempt += 1
+                    await asyncio.sleep(min(2 ** attempt, 30))
+                    continue
+                status_code = getattr(e, "status_code", None) or extract_status_code_from_error(str(e))
+                save_analytics(
+                    gateway_id=gateway.id,
+                    gateway=gateway,
+                    model=routes[0].model,
+                    provider=routes[0].provider,
+                    request_type="batch",
+                    status=False,
+                    queue_time=ticket.queue_time,
+                    error_message=str(e),
+                    prompt_text=request.prompt_text,
+                    http_status_code=status_code,
+                    endpoint="/batches",
+                )
+                return _output_line(custom_id, status_code, error={"code": "upstream_error", "message": str(e)})
+            finally:
+                ticket.release()
+
+            # Some providers leave usage out
+            tokens_prompt = completion.usage.prompt_tokens if completion.usage else 0
+            tokens_completion = completion.usage.completion_tokens if completion.usage else 0
+            reservation.settle(tokens_prompt + tokens_completion)
+            save_analytics(
+                chat_id=completion.id,
+                gateway_id=gateway.id,
+                gateway=gateway,
+                model=route.model,
+                provider=route.provider,
+                tokens_prompt=tokens_prompt,
+                tokens_completion=tokens_completion,
+                request_type="batch",
+                status=True,
+                cost=route.cost(tokens_prompt, tokens_completion),
+                latency=time.time() - start_time,
+                queue_time=ticket.queue_time,
+                prompt_text=request.prompt_text,
+                response_text=completion.choices[0].message.content,
+                http_status_code=200,
+                endpoint="/batches",
+            )
+            return _output_line(custom_id, 200, completion.model_dump())
+
+    def _native_client(self, state):
+        with open(self._path(state["id"], "input.jsonl")) as f:
+            model = json.loads(f.readline())["body"]["model"]
+        route = resolve_route(model, self._api_keys.get(state["id"]))[0]
+        # Every call for a native batch has to use the account that created it
+        return client_pool.lease(route.base_url, route.api_key or key_pools.first_key(route.provider))
+
+    async def _run_native(self, state, api_key):
+        """Hand the batch to the provider's own (discounted) batch API and poll it until it is done"""
+        batch_id = state["id"]
+        try:
+            async with self._native_client(state) as client:
+                if state["native_batch_id"] is None:
+                    items = await asyncio.to_thread(self._read_input, batch_id)
+                    lines = []
+                    for item in items:
+                        body = dict(item["body"], model=resolve_route(item["body"]["model"], api_key)[0].model)
+                        body.pop("stream", None)
+                        lines.append(json.dumps({
+                            "custom_id": item["custom_id"],
+                            "method": "POST",
+                            "url": "/v1/chat/completions",
+                            "body": body,
+                        }))
+                    upload = await client.files.create(
+                        file=("batch.jsonl", ("\n".join(lines) + "\n").encode()), purpose="batch"
+                    )
+                    native = await client.batches.create(
+                        input_file_id=upload.id, endpoint="/v1/chat/completions", completion_window="24h"
+                    )
+                    state["native_batch_id"] = native.id
+                    state["status"] = "in_progress"
+                    state["started_at"] = time.time()
+                    self._save_state(state)
+
+                while True:
+                    native = await client.batches.retrieve(state["native_batch_id"])
+                    if native.request_counts:
+                        state["completed"] = native.request_counts.completed
+                        state["failed"] = native.request_counts.failed
+                    if native.status in NATIVE_DONE:
+                        break
+                    self._save_state(state)
+                    await asyncio.sleep(BATCH_NATIVE_POLL_SECONDS)
+
+                with open(self.output_path(batch_id), "wb") as output:
+                    for file_id in (native.output_file_id, native.error_file_id):
+                        if file_id:
+                            content = await client.files.content(file_id)
+                            output.write(content.content)
+            async with SessionLocal() as db:
+                gateway = await auth_cache.gateway(state["gateway_id"], db)
+            self._record_native_usage(state, gateway)
+            if native.status == "completed":
+                self._finish(state, "completed")
+            else:
+                self._finish(state, "failed" if native.status != "cancelled" else "cancelled",
+                             f"Native batch {native.status}")
+        except asyncio.CancelledError:
+            if state["status"] in ACTIVE:
+                self._save_state(state)
+            raise
+        except Exception as e:
+            print(f"Batch {batch_id} failed: {e}")
+            self._finish(state, "failed", str(e))
+
+    def _record_native_usage(self, state, gateway):
+        discount = NATIVE_BATCH_DISCOUNT[state["native_provider"]]
+        # The provider reports its dated snapshot name, which has no price in the
+        # catalog: price each line by the route of the model it asked for
+        routes = {}
+        requested = {}
+        for item in self._read_input(state["id"]):
+            model = item["body"]["model"]
+            if model not in routes:
+                try:
+                    routes[model] = resolve_single_route(model)
+                except HTTPException:
+                    routes[model] = None
+            requested[item["custom_id"]] = routes[model]
+        with open(self.output_path(state["id"])) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                response = entry.get("response") or {}
+                body = response.get("body") or {}
+                usage = body.get("usage") or {}
+                tokens_prompt = usage.get("prompt_tokens", 0)
+                tokens_completion = usage.get("completion_tokens", 0)
+                route = requested.get(entry.get("custom_id"))
+                save_analytics(
+                    chat_id=body.get("id"),
+                    gateway_id=state["gateway_id"],
+                    gateway=gateway,
+                    model=route.model if route else body.get("model"),
+                    provider=state["native_provider"],
+                    tokens_prompt=tokens_prompt,
+                    tokens_completion=tokens_completion,
+                    request_type="batch_native",
+                    status=response.get("status_code") == 200,
+                    cost=discount * route.cost(tokens_prompt, tokens_completion) if route else 0,
+                    error_message=json.dumps(entry["error"]) if entry.get("error") else None,
+                    http_status_code=response.get("status_code"),
+                    endpoint="/batches",
+                )
+
+    def running(self):
+        return len(self._tasks)
+
+
+batch_manager = BatchManager()
+
+CallbackMetric("gateway_batches_running", "Batches being processed", batch_manager.running)
@@ -0,0 +1,147 @@
+import os
+import time
+from collections import deque
+
+import httpx
+import openai
+
+from key_pool import KeyPoolExhausted
+from metrics import CallbackMetric
+from sse import StreamError
+
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", "20"))
+CIRCUIT_MIN_REQUESTS = int(os.getenv("CIRCUIT_MIN_REQUESTS", "5"))
+# Share of failed (or slow) calls in the window that opens the circuit
+CIRCUIT_FAILURE_RATIO = float(os.getenv("CIRCUIT_FAILURE_RATIO", "0.5"))
+# Calls slower than this count as failures
+CIRCUIT_SLOW_SECONDS = float(os.getenv("CIRCUIT_SLOW_SECONDS", "30"))
+# How long an open circuit skips its provider before letting a probe through
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+
+class CircuitOpenError(Exception):
+    """Every candidate route was skipped because its circuit is open"""
+
+
+def is_provider_failure(error):
+    """
+    Upstream errors that say something about the provider's health, not the
+    request: connection errors, timeouts, errors sent inside a stream and
+    5xx, 408 or 429 responses. Errors raised by the gateway or the client
+    library before anything reached the provider (no API key, an exhausted
+    key pool, a bug) never count, so one gateway cannot open the circuit
+    for everyone.
+    """
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError, StreamError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500 or error.status_code in (408, 429)
+    return False
+
+
+def is_retryable(error):
+    """Errors worth trying the next route (or a later attempt) for"""
+    return is_provider_failure(error) or isinstance(error, KeyPoolExhausted)
+
+
+class CircuitBreaker:
+    def __init__(self):
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=CIRCUIT_WINDOW)
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+
+    def allow(self, now):
+        if self.state == CLOSED:
+            return True
+        if now < self.probe_at:
+            return False
+        # Half-open: let one probe through, and another if it never reports back
+        self.state = HALF_OPEN
+        self.probe_at = now + CIRCUIT_OPEN_SECONDS
+        return True
+
+    def record(self, ok, now):
+        if self.state != CLOSED:
+            if ok:
+                self.state = CLOSED
+                self.outcomes.clear()
+            else:
+                self._open(now)
+            return
+
+        self.outcomes.append(ok)
+        if len(self.outcomes) >= CIRCUIT_MIN_REQUESTS:
+            failures = self.outcomes.count(False)
+            if failures / len(self.outcomes) >= CIRCUIT_FAILURE_RATIO:
+                self._open(now)
+
+    def _open(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self.probe_at = now + CIRCUIT_OPEN_SECONDS
+
+
+class CircuitBreakers:
+    """
+    Breakers per provider and per provider model. A route is only tried when
+    both of its breakers allow it.
+    """
+
+    def __init__(self):
+        self._breakers = {}
+
+    def _breaker(self, key):
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = self._breakers[key] = CircuitBreaker()
+        return breaker
+
+    def allow(self, route):
+        now = time.monotonic()
+        provider = self._breaker((route.provider, ""))
+        model = self._breaker((route.provider, route.model))
+        # Check the model first, so a provider probe is not spent on a model that is skipped anyway
+        return model.allow(now) and provider.allow(now)
+
+    def available(self, route):
+        """Whether both breakers are closed, without taking a half-open probe"""
+        for key in ((route.provider, ""), (route.provider, route.model)):
+            breaker = self._breakers.get(key)
+            if breaker is not None and breaker.state != CLOSED:
+                return False
+        return True
+
+    def record(self, route, ok, latency=None):
+        now = time.monotonic()
+        if ok and latency is not None and latency > CIRCUIT_SLOW_SECONDS:
+            ok = False
+        self._breaker((route.provider, "")).record(ok, now)
+        self._breaker((route.provider, route.model)).record(ok, now)
+
+    async def call(self, route, attempt):
+        """Run attempt(route), recording its outcome"""
+        start = time.perf_counter()
+        try:
+            result = await attempt(route)
+        except Exception as e:
+            if is_provider_failure(e):
+                self.record(route, False)
+            raise
+        self.record(route, True, time.perf_counter() - start)
+        return result
+
+    def states(self):
+        return {key: {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}[breaker.state] for key, breaker in self._breakers.items()}
+
+
+circuit_breakers = CircuitBreakers()
+
+CallbackMetric(
+    "gateway_circuit_state",
+    "Circuit breaker state (0 closed, 1 half-open, 2 open), model is empty for provider breakers",
+    circuit_breakers.states,
+    ("provider", "model"),
+)
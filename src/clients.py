@@ -0,0 +1,92 @@
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from openai import AsyncOpenAI
+
+from metrics import CallbackMetric
+from transport import upstream_transport
+
+UPSTREAM_CLIENT_POOL_SIZE = int(os.getenv("UPSTREAM_CLIENT_POOL_SIZE", "64"))
+UPSTREAM_CLIENT_IDLE_TTL = float(os.getenv("UPSTREAM_CLIENT_IDLE_TTL", "300"))
+
+
+class _PooledClient:
+    __slots__ = ("client", "leases", "last_used")
+
+    def __init__(self, client):
+        self.client = client
+        self.leases = 0
+        self.last_used = time.monotonic()
+
+
+class ClientPool:
+    """
+    LRU registry of upstream AsyncOpenAI clients keyed by (base_url, api_key,
+    max_retries).
+    Clients are thin wrappers over the shared per-host connection pools of
+    the transport layer, so evicting one never closes connections that other
+    clients or in-flight streams are using.
+    """
+
+    def __init__(self, transport=upstream_transport, maxsize=UPSTREAM_CLIENT_POOL_SIZE,
+                 idle_ttl=UPSTREAM_CLIENT_IDLE_TTL):
+        self.transport = transport
+        self.maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        self._clients = OrderedDict()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def _new_client(self, base_url, api_key, max_retries=None):
+        options = {} if max_retries is None else {"max_retries": max_retries}
+        return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self.transport.http_client(base_url), **options)
+
+    def _checkout(self, base_url, api_key, max_retries=None):
+        key = (base_url, api_key, max_retries)
+        entry = self._clients.get(key)
+        if entry is None:
+            entry = _PooledClient(self._new_client(base_url, api_key, max_retries))
+            self._clients[key] = entry
+        else:
+            self._clients.move_to_end(key)
+        entry.leases += 1
+        entry.last_used = time.monotonic()
+        self._evict()
+        return entry
+
+    def _checkin(self, entry):
+        entry.leases -= 1
+        entry.last_used = time.monotonic()
+
+    def _evict(self):
+        now = time.monotonic()
+        for key, entry in list(self._clients.items()):
+            over_capacity = len(self._clients) > self.maxsize
+            idle_expired = now - entry.last_used > self.idle_ttl
+            if not over_capacity and not idle_expired:
+                # Entries are in LRU order, nothing further along is older
+                break
+            if entry.leases:
+                continue
+            del self._clients[key]
+
+    @asynccontextmanager
+    async def lease(self, base_url, api_key, max_retries=None):
+        entry = self._checkout(base_url, api_key, max_retries)
+        try:
+            yield entry.client
+        finally:
+            self._checkin(entry)
+
+    async def aclose(self):
+        # The wrappers own no sockets, closing the transport drops the connections
+        self._clients.clear()
+        await self.transport.aclose()
+
+
+client_pool = ClientPool()
+
+CallbackMetric("gateway_client_pool_size", "Pooled upstream API clients", lambda: len(client_pool))
@@ -0,0 +1,39 @@
+import asyncio
+import os
+
+# Share one upstream call between identical concurrent non-streaming requests
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "false").lower() == "true"
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. The call runs as its own task,
+    so it keeps going for the remaining waiters if the caller that started
+    it disconnects.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._inflight)
+
+    async def do(self, key, fn):
+        """Returns (result, coalesced), coalesced being True when another caller's call was joined"""
+        task = self._inflight.get(key)
+        coalesced = task is not None
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task), coalesced
+
+    def _finish(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception as retrieved in case every waiter went away
+        if not task.cancelled():
+            task.exception()
+
+
+single_flight = SingleFlight()
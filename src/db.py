@@ -1,9 +1,11 @@
-from sqlalchemy import Column, Integer, String, create_engine, ForeignKey
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
-from sqlalchemy.sql import func
+from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey, event, inspect, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.sql import func, true, false
 from sqlalchemy import DateTime
-from sqlalchemy.pool import StaticPool
 import os
+import re
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -26,36 +28,103 @@ class Gateway(Base):
     id = Column(String, primary_key=True)
     name = Column(String)
     secret_key = Column(String)
-    user_id = Column(String, ForeignKey("users.id"), nullable=False)
+    user_id = Column(String, ForeignKey("users.id"), nullable=False, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    # Response cache for deterministic requests (temperature 0 or x-gateway-cache header)
+    cache_enabled = Column(Boolean, nullable=False, default=True, server_default=true())
+    cache_ttl = Column(Integer, nullable=True)
+    # Similarity (0-1) above which a near-duplicate prompt is served from the cache, NULL disables it
+    near_cache_threshold = Column(Float, nullable=True)
+    # Fire a backup upstream request when the first one is slower than the route's p95
+    hedging_enabled = Column(Boolean, nullable=False, default=False, server_default=false())
+    # Requests and tokens per minute, NULL for no limit
+    rpm_limit = Column(Integer, nullable=True)
+    tpm_limit = Column(Integer, nullable=True)
+    # Share of queued upstream slots relative to other gateways, NULL counts as 1
+    queue_weight = Column(Float, nullable=True)
+    # Which requests keep full prompt and response bodies in analytics: errors always, requests at or over
+    # the latency (seconds) and cost thresholds, and this share of the rest; NULL uses ANALYTICS_CAPTURE_*
+    capture_sample_rate = Column(Float, nullable=True)
+    capture_latency_threshold = Column(Float, nullable=True)
+    capture_cost_threshold = Column(Float, nullable=True)
+
     # Relationship to user
     user = relationship("User", back_populates="gateways")
     
 
 # Determine if we're in production
 ENVIRONMENT = os.getenv("ENVIRONMENT", "development").lower()
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+
+
+def async_database_url(url):
+    """The asyncpg form of a postgres:// or postgresql[+driver]:// URL"""
+    scheme, _, rest = url.partition("://")
+    if scheme in ("postgres", "postgresql") or scheme.startswith("postgresql+"):
+        # asyncpg takes libpq's sslmode values as ssl
+        rest = re.sub(r"([?&])sslmode=", r"\1ssl=", rest)
+        return f"postgresql+asyncpg://{rest}"
+    return url
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # Readers no longer wait for the writer, and writers wait for each other instead of failing
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
 
 # Create engine based on environment
 if ENVIRONMENT == "production":
-    # Use PostgreSQL in production
+    # Use PostgreSQL (asyncpg) in production
     DATABASE_URL = os.getenv("DATABASE_URL")
     if not DATABASE_URL:
         raise ValueError("DATABASE_URL environment variable is required in production")
-    engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+    engine = create_async_engine(
+        async_database_url(DATABASE_URL),
+        pool_pre_ping=True,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+    )
 else:
-    # Use SQLite in development
-    engine = create_engine(
-        "sqlite:///./gateway1.db",
-        connect_args={"check_same_thread": False},
-        poolclass=StaticPool,
+    # Use SQLite (aiosqlite) in development, a pool of connections to a WAL database
+    engine = create_async_engine(
+        os.getenv("SQLITE_URL", "sqlite+aiosqlite:///./gateway1.db"),
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
     )
+    event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
 
-SessionLocal = sessionmaker(bind=engine)
+SessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
+
+
+def _migrate(conn):
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(conn)
+
+
+async def create_schema():
+    """Create missing tables, then add the columns and indexes introduced after they were first created"""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_migrate)
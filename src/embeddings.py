@@ -0,0 +1,146 @@
+import asyncio
+import os
+
+from admission import admission
+from metrics import Counter, observe_stage
+from upstream import create_embedding
+
+# How long the first request of a batch waits for others to join it
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+# Most inputs merged into one upstream call
+EMBEDDING_BATCH_MAX_INPUTS = int(os.getenv("EMBEDDING_BATCH_MAX_INPUTS", "256"))
+
+EMBEDDING_CALLS = Counter(
+    "gateway_embedding_calls_total", "Embedding requests received, and the upstream calls they were merged into", ("kind",)
+)
+
+
+class EmbeddingResult:
+    """One request's share of a merged upstream call"""
+
+    __slots__ = ("route", "model", "embeddings", "tokens", "batch_size", "queue_time")
+
+    def __init__(self, route, model, embeddings, tokens, batch_size, queue_time):
+        self.route = route
+        self.model = model
+        self.embeddings = embeddings
+        self.tokens = tokens
+        # Requests that shared the upstream call
+        self.batch_size = batch_size
+        # Wait for the upstream slot the call held
+        self.queue_time = queue_time
+
+
+class _Batch:
+    __slots__ = ("routes", "params", "gateway", "lane", "entries", "size", "handle")
+
+    def __init__(self, routes, params, gateway, lane, entries=None):
+        self.routes = routes
+        self.params = params
+        self.gateway = gateway
+        self.lane = lane
+        # (inputs, future) per request
+        self.entries = entries or []
+        self.size = sum(len(inputs) for inputs, _ in self.entries)
+        self.handle = None
+
+
+class EmbeddingBatcher:
+    """
+    Merges concurrent embedding requests for the same routes (so the same
+    API key) and parameters into one upstream call. The first request opens
+    a batch that is sent after EMBEDDING_BATCH_WINDOW_MS, or as soon as it
+    holds EMBEDDING_BATCH_MAX_INPUTS inputs. Only the upstream call takes an
+    admission slot, so batches are per gateway and lane. Each request gets
+    its own vectors back, and the usage split by input length.
+    """
+
+    def __init__(self, window_ms=EMBEDDING_BATCH_WINDOW_MS, max_inputs=EMBEDDING_BATCH_MAX_INPUTS):
+        self.window = window_ms / 1000
+        self.max_inputs = max_inputs
+        self._open = {}
+        self._tasks = set()
+
+    async def embed(self, routes, inputs, gateway, lane=None, **params):
+        EMBEDDING_CALLS.inc(kind="request")
+        future = asyncio.get_running_loop().create_future()
+        if not self.window or len(inputs) >= self.max_inputs:
+            # Nothing to wait for, a request this large fills a batch on its own
+            self._send_now(_Batch(routes, params, gateway, lane, [(inputs, future)]))
+            return await future
+
+        key = (tuple(routes), tuple(sorted(params.items())), gateway.id, lane)
+        batch = self._open.get(key)
+        if batch is not None and batch.size + len(inputs) > self.max_inputs:
+            self._flush(key)
+            batch = None
+        if batch is None:
+            batch = self._open[key] = _Batch(routes, params, gateway, lane)
+            batch.handle = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+        batch.entries.append((inputs, future))
+        batch.size += len(inputs)
+        if batch.size >= self.max_inputs:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key):
+        batch = self._open.pop(key, None)
+        if batch is None:
+            return
+        batch.handle.cancel()
+        self._send_now(batch)
+
+    def _send_now(self, batch):
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch):
+        inputs = [text for entry_inputs, _ in batch.entries for text in entry_inputs]
+        EMBEDDING_CALLS.inc(kind="upstream_call")
+        try:
+            ticket = await admission.acquire(batch.gateway, batch.lane)
+        except Exception as e:
+            for _, future in batch.entries:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        primary = batch.routes[0]
+        observe_stage("queue", ticket.queue_time, primary.provider, primary.model, batch.gateway.id)
+        try:
+            route, response = await create_embedding(batch.routes, inputs, **batch.params)
+        except Exception as e:
+            status = getattr(e, "status_code", None)
+            if len(batch.entries) > 1 and status is not None and 400 <= status < 500 and status != 429:
+                # One bad input fails the whole call, so retry each request alone and only its caller gets the error
+                for entry in batch.entries:
+                    self._send_now(_Batch(batch.routes, batch.params, batch.gateway, batch.lane, [entry]))
+                return
+            for _, future in batch.entries:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            ticket.release()
+
+        embeddings = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        total_tokens = response.usage.prompt_tokens if response.usage else 0
+        total_chars = sum(len(text) for text in inputs) or 1
+        offset = 0
+        for entry_inputs, future in batch.entries:
+            chars = sum(len(text) for text in entry_inputs)
+            result = EmbeddingResult(
+                route,
+                response.model,
+                embeddings[offset:offset + len(entry_inputs)],
+                round(total_tokens * chars / total_chars),
+                len(batch.entries),
+                ticket.queue_time,
+            )
+            offset += len(entry_inputs)
+            # A caller that went away has a cancelled future
+            if not future.done():
+                future.set_result(result)
+
+
+embedding_batcher = EmbeddingBatcher()
@@ -0,0 +1,265 @@
+import functools
+import inspect
+import io
+import os
+import zlib
+
+import anyio
+import orjson
+import zstandard
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import APIRoute
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+
+# Responses smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))
+# Largest request body accepted after decompression
+MAX_REQUEST_BODY_BYTES = int(os.getenv("MAX_REQUEST_BODY_BYTES", str(100 * 1024 * 1024)))
+
+# Response codings in order of preference when the client accepts several equally
+RESPONSE_CODINGS = ("zstd", "gzip")
+# Bodies larger than this are compressed and decompressed off the event loop
+_THREAD_THRESHOLD = 256 * 1024
+_CHUNK = 64 * 1024
+
+
+def _default(value):
+    # Types orjson does not encode natively (Decimal, sets, pydantic models, ...)
+    return jsonable_encoder(value)
+
+
+def dumps(content):
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return dumps(content)
+
+
+def _respond(result):
+    if isinstance(result, (dict, list)):
+        return FastJSONResponse(result)
+    return result
+
+
+def fast_json(endpoint):
+    """
+    Wrap an endpoint so the dicts and lists it returns are encoded straight
+    to JSON, skipping FastAPI's jsonable_encoder pass over the whole result.
+    """
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapped(*args, **kwargs):
+            return _respond(await endpoint(*args, **kwargs))
+    else:
+        @functools.wraps(endpoint)
+        def wrapped(*args, **kwargs):
+            return _respond(endpoint(*args, **kwargs))
+    return wrapped
+
+
+class FastJSONRoute(APIRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, fast_json(endpoint), **kwargs)
+
+
+def negotiate(accept_encoding):
+    """The response coding to use for an Accept-Encoding header, or None"""
+    weights = {}
+    for item in accept_encoding.lower().split(","):
+        coding, _, params = item.partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding.strip()] = weight
+    best = None
+    for coding in RESPONSE_CODINGS:
+        weight = weights.get(coding, weights.get("*", 0.0))
+        if weight > 0 and (best is None or weight > best[1]):
+            best = (coding, weight)
+    return best and best[0]
+
+
+class Compressor:
+    """Incremental gzip or zstd compression of a response body"""
+
+    def __init__(self, coding):
+        self.coding = coding
+        if coding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self._sync_flush = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            self._sync_flush = zlib.Z_SYNC_FLUSH
+
+    def compress(self, data, final):
+        compressed = self._compressor.compress(data)
+        if final:
+            return compressed + self._compressor.flush()
+        # Each chunk of a streamed body is flushed so it reaches the client right away
+        return compressed + self._compressor.flush(self._sync_flush)
+
+    async def compress_async(self, data, final):
+        if len(data) > _THREAD_THRESHOLD:
+            return await anyio.to_thread.run_sync(self.compress, data, final)
+        return self.compress(data, final)
+
+
+class RequestBodyError(Exception):
+    def __init__(self, status_code, detail):
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _decompressed_chunks(body, coding):
+    if coding == "zstd":
+        yield from zstandard.ZstdDecompressor().read_to_iter(io.BytesIO(body), write_size=_CHUNK)
+        return
+    # gzip, or deflate with its zlib header
+    decompressor = zlib.decompressobj(31 if coding in ("gzip", "x-gzip") else 15)
+    data = body
+    while data:
+        yield decompressor.decompress(data, _CHUNK)
+        data = decompressor.unconsumed_tail
+    yield decompressor.flush()
+
+
+def decompress(body, coding, limit=MAX_REQUEST_BODY_BYTES):
+    """Decompress a request body, stopping as soon as it grows over limit"""
+    output = bytearray()
+    try:
+        for chunk in _decompressed_chunks(body, coding):
+            output += chunk
+            if len(output) > limit:
+                raise RequestBodyError(413, f"Request body is larger than {limit} bytes")
+    except (zlib.error, zstandard.ZstdError) as e:
+        raise RequestBodyError(400, f"Invalid {coding} request body: {e}")
+    return bytes(output)
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses with zstd or gzip, whichever the client prefers in
+    Accept-Encoding, once they are larger than COMPRESSION_MIN_SIZE. Event
+    streams are never compressed. Request bodies sent with a gzip, deflate
+    or zstd Content-Encoding are decompressed before they reach the app.
+    """
+
+    DECODABLE = ("gzip", "x-gzip", "deflate", "zstd")
+
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        content_encoding = headers.get("content-encoding", "identity").strip().lower()
+        if content_encoding != "identity":
+            try:
+                scope, receive = await self._decompress_request(scope, receive, content_encoding)
+            except RequestBodyError as e:
+                await JSONResponse({"detail": e.detail}, e.status_code)(scope, receive, send)
+                return
+
+        coding = negotiate(headers.get("accept-encoding", ""))
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        compressor = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                if start is not None:
+                    await send(start)
+                    start = None
+                await send(message)
+                return
+            if passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                response_headers = MutableHeaders(raw=start["headers"])
+                if ("content-encoding" in response_headers
+                        or response_headers.get("content-type", "").startswith("text/event-stream")
+                        or (not more_body and len(body) < self.minimum_size)):
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                compressor = Compressor(coding)
+                body = await compressor.compress_async(body, not more_body)
+                response_headers.add_vary_header("Accept-Encoding")
+                response_headers["Content-Encoding"] = coding
+                if more_body:
+                    del response_headers["Content-Length"]
+                else:
+                    response_headers["Content-Length"] = str(len(body))
+                await send(start)
+                await send({"type": "http.response.body", "body": body, "more_body": more_body})
+                return
+            body = await compressor.compress_async(body, not more_body)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+    async def _decompress_request(self, scope, receive, coding):
+        if coding not in self.DECODABLE:
+            raise RequestBodyError(415, f"Unsupported Content-Encoding: {coding}")
+
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] != "http.request":
+                # The client went away before sending its body
+                raise RequestBodyError(400, "Request body was not received")
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            if size > MAX_REQUEST_BODY_BYTES:
+                raise RequestBodyError(413, f"Request body is larger than {MAX_REQUEST_BODY_BYTES} bytes")
+            more_body = message.get("more_body", False)
+        body = b"".join(chunks)
+
+        if len(body) > _THREAD_THRESHOLD:
+            body = await anyio.to_thread.run_sync(decompress, body, coding)
+        else:
+            body = decompress(body, coding)
+
+        scope = dict(scope)
+        scope["headers"] = [
+            (name, value) for name, value in scope["headers"] if name not in (b"content-encoding", b"content-length")
+        ] + [(b"content-length", str(len(body)).encode())]
+
+        sent = False
+
+        async def receive_decompressed():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        return scope, receive_decompressed
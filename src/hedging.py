@@ -0,0 +1,141 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+
+from metrics import CallbackMetric
+
+# Models hedged on every gateway; gateways can also opt in with hedging_enabled
+HEDGE_MODELS = {model.strip() for model in os.getenv("HEDGE_MODELS", "").split(",") if model.strip()}
+# Hedges allowed per hedge-eligible request, capping the extra upstream spend
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.2"))
+# Used until a route has enough samples for its own p95
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "2.0"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+HEDGE_MIN_SAMPLES = 20
+
+
+class HedgeOutcome:
+    __slots__ = ("hedged", "won")
+
+    def __init__(self):
+        # hedged: a second request was fired; won: the second request answered first
+        self.hedged = False
+        self.won = False
+
+
+class HedgeBudget:
+    """Token bucket refilled by each eligible request, so hedges stay a fixed fraction of traffic"""
+
+    def __init__(self, ratio=HEDGE_BUDGET, burst=10.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def deposit(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def take(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Hedger:
+    """
+    Fires a backup request when the first one has not answered within the
+    route's live p95 time to first byte, and keeps whichever answers first.
+    """
+
+    def __init__(self, budget=None, window=HEDGE_WINDOW):
+        self.budget = budget or HedgeBudget()
+        self.window = window
+        self._samples = {}
+        self.fired = 0
+        self.won = 0
+
+    def enabled(self, gateway, model):
+        return bool(getattr(gateway, "hedging_enabled", False)) or model in HEDGE_MODELS
+
+    def record(self, route_key, seconds):
+        samples = self._samples.get(route_key)
+        if samples is None:
+            samples = self._samples[route_key] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def delay(self, route_key):
+        samples = self._samples.get(route_key)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return max(HEDGE_MIN_DELAY, HEDGE_DEFAULT_DELAY)
+        ordered = sorted(samples)
+        p95 = ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+        return max(HEDGE_MIN_DELAY, p95)
+
+    async def _timed(self, route_key, attempt):
+        start = time.perf_counter()
+        result = await attempt()
+        self.record(route_key, time.perf_counter() - start)
+        return result
+
+    async def race(self, route_key, primary, backup=None, release=None):
+        """
+        Runs primary(), and backup() too if primary is slower than the hedge
+        delay. Both are coroutine functions returning once the upstream has
+        produced its first byte. Returns (result, HedgeOutcome); the losing
+        request is cancelled, or passed to release() if it had already answered.
+        """
+        outcome = HedgeOutcome()
+        tasks = [asyncio.ensure_future(self._timed(route_key, primary))]
+        winner = None
+        try:
+            if backup is not None:
+                self.budget.deposit()
+                done, _ = await asyncio.wait(tasks, timeout=self.delay(route_key))
+                if not done and self.budget.take():
+                    tasks.append(asyncio.ensure_future(self._timed(route_key, backup)))
+                    outcome.hedged = True
+                    self.fired += 1
+
+            pending = set(tasks)
+            while pending and winner is None:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Prefer the primary when both finished in the same iteration
+                for task in tasks:
+                    if task.done() and not task.cancelled() and task.exception() is None:
+                        winner = task
+                        break
+            if winner is None:
+                # Every attempt failed, surface the primary's error
+                return tasks[0].result(), outcome
+
+            if winner is not tasks[0]:
+                outcome.won = True
+                self.won += 1
+            return winner.result(), outcome
+        finally:
+            for task in tasks:
+                if task is not winner and not task.done():
+                    task.cancel()
+            for task in tasks:
+                if task is winner:
+                    continue
+                try:
+                    result = await task
+                except BaseException:
+                    continue
+                if release is not None:
+                    await release(result)
+
+
+hedger = Hedger()
+
+CallbackMetric(
+    "gateway_hedges_total",
+    "Hedged upstream requests by outcome",
+    lambda: {"fired": hedger.fired, "won": hedger.won},
+    ("result",),
+    metric_type="counter",
+)
@@ -0,0 +1,197 @@
+import json
+import os
+import re
+import time
+
+from metrics import CallbackMetric, Counter
+from routing import route_catalog
+
+# Seconds a key sits out after a 429 that did not say when to retry
+KEY_COOLDOWN_SECONDS = float(os.getenv("KEY_COOLDOWN_SECONDS", "30"))
+
+FREE_PROVIDER = "playground"
+
+KEY_COOLDOWNS = Counter("gateway_api_key_cooldowns_total", "API keys cooled down after a 429", ("provider",))
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class KeyPoolExhausted(Exception):
+    """Every key of a provider is cooling down after a 429"""
+
+    status_code = 429
+
+
+def parse_duration(value):
+    """Seconds from a rate limit reset header, e.g. "1s", "6m0s", "20ms" or "0.5" """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _UNITS[unit] for amount, unit in parts)
+
+
+def _int_header(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class KeyState:
+    def __init__(self, key):
+        self.key = key
+        self.limit_requests = None
+        self.remaining_requests = None
+        self.reset_requests_at = 0.0
+        self.limit_tokens = None
+        self.remaining_tokens = None
+        self.reset_tokens_at = 0.0
+        self.cooldown_until = 0.0
+        self.last_used = 0.0
+
+    @property
+    def label(self):
+        return f"...{self.key[-4:]}"
+
+    def headroom(self, now):
+        """Smallest share of the request and token quotas left, 1.0 until the provider tells us"""
+        if self.limit_requests and now >= self.reset_requests_at:
+            self.remaining_requests = self.limit_requests
+        if self.limit_tokens and now >= self.reset_tokens_at:
+            self.remaining_tokens = self.limit_tokens
+        shares = [1.0]
+        if self.limit_requests and self.remaining_requests is not None:
+            shares.append(self.remaining_requests / self.limit_requests)
+        if self.limit_tokens and self.remaining_tokens is not None:
+            shares.append(self.remaining_tokens / self.limit_tokens)
+        return max(0.0, min(shares))
+
+    def observe(self, headers, now):
+        limit = _int_header(headers, "x-ratelimit-limit-requests")
+        remaining = _int_header(headers, "x-ratelimit-remaining-requests")
+        if remaining is not None:
+            self.limit_requests = limit or max(self.limit_requests or 0, remaining)
+            self.remaining_requests = remaining
+            self.reset_requests_at = now + (parse_duration(headers.get("x-ratelimit-reset-requests")) or 60)
+        limit = _int_header(headers, "x-ratelimit-limit-tokens")
+        remaining = _int_header(headers, "x-ratelimit-remaining-tokens")
+        if remaining is not None:
+            self.limit_tokens = limit or max(self.limit_tokens or 0, remaining)
+            self.remaining_tokens = remaining
+            self.reset_tokens_at = now + (parse_duration(headers.get("x-ratelimit-reset-tokens")) or 60)
+
+
+class KeyPool:
+    """API keys of one provider, picked by the most rate limit headroom"""
+
+    def __init__(self, provider, keys):
+        self.provider = provider
+        self.keys = [KeyState(key) for key in dict.fromkeys(keys)]
+
+    def pick(self):
+        now = time.monotonic()
+        available = [key for key in self.keys if key.cooldown_until <= now]
+        if not available:
+            retry_after = min(key.cooldown_until for key in self.keys) - now
+            raise KeyPoolExhausted(f"Error code: 429 - every {self.provider} key is rate limited, retry in {retry_after:.0f}s")
+        # Least recently used key wins ties, which spreads load before any headers arrive
+        key = max(available, key=lambda key: (key.headroom(now), -key.last_used))
+        key.last_used = now
+        if key.remaining_requests:
+            # Debit locally, the provider's headers only arrive with the response
+            key.remaining_requests -= 1
+        return key
+
+
+class KeyPools:
+    def __init__(self, keys_by_provider):
+        self._pools = {provider: KeyPool(provider, keys) for provider, keys in keys_by_provider.items() if keys}
+
+    def has_pool(self, provider):
+        return provider in self._pools
+
+    def first_key(self, provider):
+        """A fixed key of the pool, for work that has to stay on one account"""
+        pool = self._pools.get(provider)
+        return pool.keys[0].key if pool else None
+
+    async def call(self, route, request):
+        """
+        Run request(api_key), which returns (result, response headers). A
+        pooled key that gets a 429 is cooled down and the next one is tried.
+        """
+        pool = self._pools.get(route.provider) if route.api_key is None else None
+        if pool is None:
+            result, _ = await request(route.api_key)
+            return result
+
+        for _ in range(len(pool.keys)):
+            key = pool.pick()
+            try:
+                result, headers = await request(key.key)
+            except Exception as e:
+                if getattr(e, "status_code", None) != 429:
+                    raise
+                self._cool_down(key, route, e)
+                last_error = e
+                continue
+            if headers is not None:
+                key.observe(headers, time.monotonic())
+            return result
+        raise last_error
+
+    def _cool_down(self, key, route, error):
+        response = getattr(error, "response", None)
+        headers = response.headers if response is not None else {}
+        wait = (
+            parse_duration(headers.get("retry-after"))
+            or parse_duration(headers.get("x-ratelimit-reset-requests"))
+            or parse_duration(headers.get("x-ratelimit-reset-tokens"))
+            or KEY_COOLDOWN_SECONDS
+        )
+        key.cooldown_until = time.monotonic() + wait
+        KEY_COOLDOWNS.inc(provider=route.provider)
+
+    def headroom(self):
+        now = time.monotonic()
+        return {
+            (provider, key.label): 0.0 if key.cooldown_until > now else key.headroom(now)
+            for provider, pool in self._pools.items()
+            for key in pool.keys
+        }
+
+
+def _split_keys(value):
+    return [key.strip() for key in (value or "").split(",") if key.strip()]
+
+
+def load_keys():
+    """
+    Keys per provider from PROVIDER_API_KEYS (JSON), <PROVIDER>_API_KEYS or
+    <PROVIDER>_API_KEY (comma separated), and FREE_MODEL_API_KEY for the free model.
+    """
+    keys = {}
+    for provider in route_catalog.current.providers:
+        prefix = provider.upper().replace("-", "_")
+        keys[provider] = _split_keys(os.getenv(f"{prefix}_API_KEYS")) + _split_keys(os.getenv(f"{prefix}_API_KEY"))
+    keys[FREE_PROVIDER] = _split_keys(os.getenv("FREE_MODEL_API_KEY"))
+    for provider, provider_keys in json.loads(os.getenv("PROVIDER_API_KEYS", "{}")).items():
+        keys.setdefault(provider, []).extend(provider_keys)
+    return keys
+
+
+key_pools = KeyPools(load_keys())
+
+CallbackMetric(
+    "gateway_api_key_headroom",
+    "Share of the rate limit left per pooled API key (0 while cooling down)",
+    key_pools.headroom,
+    ("provider", "key"),
+)
@@ -1,26 +1,50 @@
+import asyncio
 import json
 import time
 import sys
 import os
 from pathlib import Path
 import uuid
+import anyio
+from starlette.background import BackgroundTask
 from starlette.responses import StreamingResponse
 
 # Add the src directory to the path for imports
 sys.path.insert(0, str(Path(__file__).parent))
 
-from db import Base, engine, get_db, Gateway, User
-from models import ChatCompletionRequest, GatewayCreate
-from utils import resolve_route, validate_gateway, extract_status_code_from_error, get_cost, make_cache_key, analytics_cache, generate_username, get_current_user
-from analytics import save_analytics, Analytics_Base, analytics_engine, _Session, RequestAnalytics
-
-from fastapi import FastAPI, Header, Query, Depends, HTTPException
+from db import create_schema, engine, get_db, Gateway, User
+from sqlalchemy import select
+from models import AuthCacheInvalidation, EmbeddingRequest, GatewayCreate, GatewaySettings
+from utils import resolve_route, validate_gateway, extract_status_code_from_error, make_cache_key, make_request_key, analytics_cache, generate_username, get_current_user, require_admin
+from analytics import save_analytics, analytics_writer, ensure_analytics_schema, analytics_engine, _Session, RequestAnalytics, load_bodies, prompt_from_bodies
+from clients import client_pool
+from coalesce import COALESCE_REQUESTS, single_flight
+from response_cache import response_cache, is_cacheable, replay_stream
+from near_cache import near_index, fingerprint
+from hedging import hedger
+from upstream import open_upstream_stream, pooled_key_retries, call_routes, create_completion
+from key_pool import key_pools
+from routing import route_catalog, CatalogError
+from auth_cache import auth_cache
+from rate_limit import rate_limiter, estimate_tokens, estimate_prompt_tokens
+from admission import admission
+from circuit import circuit_breakers, is_provider_failure
+from batches import batch_manager
+from embeddings import embedding_batcher
+from raw_request import RawChatRequest
+from encoding import CompressionMiddleware, FastJSONResponse, FastJSONRoute
+from sse import SSE_PASSTHROUGH, SSEScanner, StreamError, StreamTimings
+from metrics import render_metrics, stage_timer, observe_stage, INFLIGHT_STREAMS, CACHE_REQUESTS
+
+from fastapi import FastAPI, Header, Query, Depends, HTTPException, Request
+from fastapi.responses import PlainTextResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
-from openai import AsyncOpenAI
 from typing import Dict, List, Optional
 
 
-app = FastAPI(title="OpenAI-compatible API")
+app = FastAPI(title="OpenAI-compatible API", default_response_class=FastJSONResponse)
+# Endpoint results are encoded with orjson, without FastAPI's jsonable_encoder pass
+app.router.route_class = FastJSONRoute
 
 # Get CORS origins from environment or use default for local development
 cors_origins = os.getenv("CORS_ORIGINS", "http://localhost:3000").split(",")
@@ -34,28 +58,82 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Negotiated zstd/gzip responses and compressed request bodies
+app.add_middleware(CompressionMiddleware)
 
 @app.on_event("startup")
 async def startup():
     # Create tables during startup if engine is available
     if analytics_engine:
         try:
-            Analytics_Base.metadata.create_all(analytics_engine)
+            await asyncio.to_thread(ensure_analytics_schema)
             print("ClickHouse connected and tables created")
         except Exception as e:
+            # Retried by the analytics writer, rows are spooled until then
             print(f"ClickHouse available but failed to create tables: {e}")
     else:
         print("ClickHouse not available, analytics will be disabled")
 
-    Base.metadata.create_all(engine)
-    
+    await create_schema()
+    batch_manager.resume()
+    # Picks up edits to the model catalog file without a restart
+    route_catalog.start()
+    # Writes analytics rows to ClickHouse in batches
+    analytics_writer.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await route_catalog.aclose()
+    await batch_manager.aclose()
+    # Rows still queued, including those of the batches stopped above
+    await analytics_writer.aclose()
+    # Close pooled upstream clients and their connection pools
+    await client_pool.aclose()
+    # Pooled database connections, aiosqlite ones hold a thread each
+    await engine.dispose()
+
+class DisconnectAwareStreamingResponse(StreamingResponse):
+    """
+    Listens for the client disconnecting while streaming, whatever the ASGI
+    spec version, and closes the body generator right away so it can cancel
+    the upstream request instead of reading it to the end.
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            async with anyio.create_task_group() as task_group:
+                async def stream():
+                    try:
+                        await self.stream_response(send)
+                    except OSError:
+                        # Writing to a client that is already gone
+                        pass
+                    task_group.cancel_scope.cancel()
+
+                task_group.start_soon(stream)
+                await self.listen_for_disconnect(receive)
+                task_group.cancel_scope.cancel()
+        finally:
+            await self.body_iterator.aclose()
+
+        if self.background is not None:
+            await self.background()
+
+
 @app.post("/chat/completions")
 async def chat_completions(
-    request: ChatCompletionRequest, authorization: str = Header(None),
+    http_request: Request, authorization: str = Header(None),
     x_gateway_authorization: str = Header(None, alias="x-gateway-authorization"),
     x_gateway_id: str = Header(None, alias="x-gateway-id"),
+    x_gateway_coalesce: str = Header(None, alias="x-gateway-coalesce"),
+    x_gateway_cache: str = Header(None, alias="x-gateway-cache"),
+    x_gateway_priority: str = Header(None, alias="x-gateway-priority"),
     db=Depends(get_db)
 ):
+    # Only the fields the gateway needs are validated, the rest is forwarded upstream as sent
+    request = RawChatRequest.from_bytes(await http_request.body())
+
     api_key = None
     if authorization and authorization.startswith("Bearer "):
         api_key = authorization.split(" ")[1]
@@ -63,63 +141,149 @@ async def chat_completions(
         if not api_key:
             return {"error": "Authorization header missing"}
 
-    gateway = validate_gateway(x_gateway_id, x_gateway_authorization, db)
+    # Unlabelled until the gateway and model are known, so callers cannot create series
+    with stage_timer("auth"):
+        gateway = await validate_gateway(x_gateway_id, x_gateway_authorization, db)
     if not gateway:
         return {"error": "Invalid Gateway ID or Authorization"}
 
-
         
     print("API KEY:", api_key)
     # print("user id:", request.user_id)
     print(x_gateway_authorization, x_gateway_id)
     # mapped_llm_url = "https://portal.qwen.ai/v1/"
     
-    model_name, provider, mapped_llm_url, resolved_api_key = resolve_route(request.model)
-    # Use resolved API key if provided, otherwise keep the one from Authorization header
-    if resolved_api_key is not None:
-        api_key = resolved_api_key
-    
-    client = AsyncOpenAI(api_key=api_key, base_url=mapped_llm_url)
-
+    route_start = time.perf_counter()
+    routes = resolve_route(request.model, api_key)
+    model_name, provider, api_key = routes[0].model, routes[0].provider, routes[0].api_key
+    observe_stage("route", time.perf_counter() - route_start, provider, model_name, x_gateway_id)
+
+    # Per-gateway RPM/TPM limits, settled against the real usage once the request is done.
+    # Taken after the route resolves, so a request for an unknown model reserves nothing
+    reservation = rate_limiter.acquire(gateway, estimate_tokens(request.prompt_text, request.max_tokens))
+
+    # Exact-match response cache for deterministic requests
+    cache_key = near_namespace = prompt_fingerprint = None
+    if is_cacheable(gateway, request.temperature, x_gateway_cache):
+        params = request.params()
+        cache_key = make_request_key(x_gateway_id, model_name, request.prompt_text, params, api_key)
+        cached = await response_cache.get(cache_key)
+        CACHE_REQUESTS.inc(cache="response", result="hit" if cached else "miss")
+
+        # Fall back to a stored completion for a near-duplicate prompt
+        if not cached and gateway.near_cache_threshold:
+            near_namespace = make_request_key(x_gateway_id, model_name, "", params, api_key)
+            prompt_fingerprint = fingerprint(request.messages)
+            near_key, _ = near_index.lookup(near_namespace, prompt_fingerprint, gateway.near_cache_threshold)
+            if near_key:
+                cached = await response_cache.get(near_key)
+                if not cached:
+                    near_index.discard(near_key)
+            CACHE_REQUESTS.inc(cache="near_duplicate", result="hit" if cached else "miss")
+
+        if cached:
+            reservation.settle(0)
+            return serve_cached_response(cached, request, gateway)
+
+    hedging = hedger.enabled(gateway, model_name)
     if request.stream:
+        # Wait for an upstream slot, the wait is recorded as the request's queue_time
+        try:
+            ticket = await admission.acquire(gateway, x_gateway_priority)
+        except HTTPException:
+            reservation.settle(0)
+            raise
+        observe_stage("queue", ticket.queue_time, provider, model_name, x_gateway_id)
+
         async def upstream_generator():
+            INFLIGHT_STREAMS.inc()
+            labels = {"provider": provider, "model": model_name, "gateway": x_gateway_id}
+            route = scanner = None
+            chunk_count = 0
+            recorded = False
             try:
                 # Track timing measurements
                 start_time = time.time()
+                upstream_start = time.perf_counter()
+                first_byte = None
+                timings = StreamTimings(upstream_start)
 
-                # 2. Call the upstream API asynchronously
-                stream = await client.chat.completions.create(
-                    model=model_name,
-                    messages=request.messages,
-                    stream=True,
-                    stream_options={"include_usage": True}
-                )
                 usage_dict = None
                 time_info = None
                 chat_id = None
                 full_response_text = ""
-                # 3. Iterate over the upstream stream
-                async for chunk in stream:
-                    # Dump the pydantic object to JSON
-                    chunk_data = chunk.model_dump_json()
-                    if chat_id is None:
-                            chat_id = chunk.id
-                    if chunk.usage:
-                        usage_dict = chunk.usage
-                    if hasattr(chunk, 'time_info') and chunk.time_info:
-                        time_info = chunk.time_info
-
-                    # Collect the full response text
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        full_response_text += chunk.choices[0].delta.content
-
-                    # 4. Format as Server-Sent Event (SSE)
-                    yield f"data: {chunk_data}\n\n"
+                events = []
+                # 2. Call the upstream API, failing over and hedging across the candidate routes
+                async def open_stream(route):
+                    async def request_stream(route_api_key):
+                        upstream = await open_upstream_stream(
+                            route.base_url, route_api_key, route.model, request, labels,
+                            pooled_key_retries(route)
+                        )
+                        return upstream, upstream.headers
+
+                    return route, await key_pools.call(route, request_stream)
+
+                (route, upstream), hedge = await call_routes(
+                    routes, open_stream, "stream", hedging, release=lambda item: item[1].aclose()
+                )
+                async with upstream:
+                    if SSE_PASSTHROUGH:
+                        # Forward the provider's SSE bytes as-is, only scanning them for analytics
+                        scanner = SSEScanner(timings, keep_payloads=bool(cache_key))
+                        async for data in upstream.chunks():
+                            timings.chunk()
+                            if first_byte is None:
+                                first_byte = timings.last_chunk
+                                observe_stage("ttfb", first_byte - upstream_start, **labels)
+                            scanner.feed(data)
+                            yield data
+
+                        if scanner.error:
+                            # Already forwarded to the client inside the stream
+                            raise StreamError(scanner.error)
+                        chat_id = scanner.chat_id
+                        usage_dict = scanner.usage
+                        time_info = scanner.time_info
+                        full_response_text = scanner.response_text()
+                        if cache_key:
+                            events = [payload.decode() for payload in scanner.payloads]
+                    else:
+                        # 3. Iterate over the upstream stream
+                        async for chunk in upstream.chunks():
+                            timings.chunk()
+                            chunk_count += 1
+                            if first_byte is None:
+                                first_byte = timings.last_chunk
+                                observe_stage("ttfb", first_byte - upstream_start, **labels)
+                            # Dump the pydantic object to JSON
+                            chunk_data = chunk.model_dump_json()
+                            if chat_id is None:
+                                    chat_id = chunk.id
+                            if chunk.usage:
+                                usage_dict = chunk.usage.model_dump()
+                            if hasattr(chunk, 'time_info') and chunk.time_info:
+                                time_info = chunk.time_info
+
+                            # Collect the full response text
+                            if chunk.choices and chunk.choices[0].delta.content:
+                                timings.token(timings.last_chunk)
+                                full_response_text += chunk.choices[0].delta.content
+
+                            if cache_key:
+                                events.append(chunk_data)
+
+                            # 4. Format as Server-Sent Event (SSE)
+                            yield f"data: {chunk_data}\n\n"
                 
+                observe_stage("stream", time.perf_counter() - upstream_start, **labels)
+                ticket.release()
+
                 if usage_dict:
-                    tokens_prompt = usage_dict.prompt_tokens
-                    tokens_completion = usage_dict.completion_tokens
-                    cost_estimate = get_cost(model_name, provider, tokens_prompt, tokens_completion)
+                    tokens_prompt = usage_dict.get("prompt_tokens") or 0
+                    tokens_completion = usage_dict.get("completion_tokens") or 0
+                    cost_estimate = route.cost(tokens_prompt, tokens_completion)
+                    reservation.settle(tokens_prompt + tokens_completion)
                 else:
                     tokens_prompt = 0
                     tokens_completion = 0
@@ -127,43 +291,112 @@ async def chat_completions(
 
                 # Use timing data from the upstream response
                 if time_info:
-                    queue_time = time_info.get('queue_time')
                     prompt_time = time_info.get('prompt_time')
                     completion_time = time_info.get('completion_time')
                     latency = time_info.get('total_time')
                 else:
                     # Fallback to manual timing if time_info not available
                     latency = time.time() - start_time
-                    queue_time = prompt_time = completion_time = None
+                    prompt_time = completion_time = None
 
                 save_analytics(
                     chat_id=chat_id,
                     gateway_id=x_gateway_id,
-                    model=model_name,
-                    provider=provider,
+                    gateway=gateway,
+                    model=route.model,
+                    provider=route.provider,
                     tokens_prompt=tokens_prompt,
                     tokens_completion=tokens_completion,
                     request_type="streaming",
                     status=True,
                     cost=cost_estimate,
                     latency=latency,
-                    queue_time=queue_time,
+                    queue_time=ticket.queue_time,
                     prompt_time=prompt_time,
                     completion_time=completion_time,
                     error_message=None,
-                    prompt_text=json.dumps([msg.model_dump() if hasattr(msg, 'model_dump') else dict(msg) for msg in request.messages]),
+                    prompt_text=request.prompt_text,
                     response_text=full_response_text,
                     http_status_code=200,
-                    endpoint="/chat/completions"
+                    endpoint="/chat/completions",
+                    hedged=hedge.hedged,
+                    hedge_won=hedge.won,
+                    # The losing request was cancelled, but its prompt was already sent
+                    hedge_wasted_tokens=tokens_prompt if hedge.hedged else 0,
+                    **timings.summary(tokens_completion)
                 )
-                # 5. Signal the end of the stream
-                yield "data: [DONE]\n\n"
-
+                # Logged and settled, a disconnect from here on must not log the request again
+                recorded = True
+                if cache_key:
+                    await response_cache.set(cache_key, {
+                        "id": chat_id,
+                        "model": route.model,
+                        "provider": route.provider,
+                        "usage": {"prompt_tokens": tokens_prompt, "completion_tokens": tokens_completion},
+                        "cost": cost_estimate,
+                        "response_text": full_response_text,
+                        "events": events,
+                    }, gateway.cache_ttl)
+                    if near_namespace:
+                        near_index.add(near_namespace, prompt_fingerprint, cache_key)
+                # 5. Signal the end of the stream, unless the provider's own marker was passed through
+                if not (SSE_PASSTHROUGH and scanner.done):
+                    yield "data: [DONE]\n\n"
+
+            except (asyncio.CancelledError, GeneratorExit):
+                if recorded:
+                    raise
+                # The client went away. Leaving `async with upstream` has already closed the
+                # upstream response, so the provider stops generating; log what was used so far.
+                served = route or routes[0]
+                if scanner is not None:
+                    full_response_text = scanner.response_text()
+                    chunk_count = scanner.events
+                    usage_dict = scanner.usage
+                if usage_dict:
+                    tokens_prompt = usage_dict.get("prompt_tokens") or 0
+                    tokens_completion = usage_dict.get("completion_tokens") or 0
+                else:
+                    # Usage only arrives at the end of a stream, estimate it (~1 token per chunk)
+                    tokens_prompt = estimate_prompt_tokens(request.prompt_text) if route else 0
+                    tokens_completion = chunk_count
+                reservation.settle(tokens_prompt + tokens_completion)
+                save_analytics(
+                    chat_id=scanner.chat_id if scanner is not None else chat_id,
+                    gateway_id=x_gateway_id,
+                    gateway=gateway,
+                    model=served.model,
+                    provider=served.provider,
+                    tokens_prompt=tokens_prompt,
+                    tokens_completion=tokens_completion,
+                    request_type="streaming",
+                    status=False,
+                    cost=served.cost(tokens_prompt, tokens_completion),
+                    latency=time.time() - start_time,
+                    queue_time=ticket.queue_time,
+                    prompt_time=None,
+                    completion_time=None,
+                    error_message="client_cancelled",
+                    prompt_text=request.prompt_text,
+                    response_text=full_response_text,
+                    http_status_code=499,
+                    endpoint="/chat/completions",
+                    **timings.summary(tokens_completion)
+                )
+                raise
             except Exception as e:
                 print(f"Error in stream: {e}")
+                if recorded:
+                    # Only the cache write failed, the request itself was logged as served
+                    return
+                reservation.settle(0)
+                if route and is_provider_failure(e):
+                    # Failed after the stream was opened, too late to fail over
+                    circuit_breakers.record(route, False)
                 error_status_code = extract_status_code_from_error(str(e))
                 save_analytics(
                     gateway_id=x_gateway_id,
+                    gateway=gateway,
                     model=model_name,
                     provider=provider,
                     tokens_prompt=0,
@@ -172,29 +405,56 @@ async def chat_completions(
                     status=False,
                     cost=0,
                     latency=None,
-                    queue_time=None,
+                    queue_time=ticket.queue_time,
                     prompt_time=None,
                     completion_time=None,
                     error_message=str(e),
-                    prompt_text=json.dumps([msg.model_dump() if hasattr(msg, 'model_dump') else dict(msg) for msg in request.messages]),
+                    prompt_text=request.prompt_text,
                     response_text=None,
                     http_status_code=error_status_code,
                     endpoint="/chat/completions"
                 )
-                error_msg = json.dumps({"error": str(e)})
-                yield f"data: {error_msg}\n\n"
+                if not isinstance(e, StreamError):
+                    error_msg = json.dumps({"error": str(e)})
+                    yield f"data: {error_msg}\n\n"
+            finally:
+                ticket.release()
+                INFLIGHT_STREAMS.dec()
 
         # 6. Return the StreamingResponse with the generator
-        return StreamingResponse(upstream_generator(), media_type="text/event-stream")
+        # The slot is also released if the stream never starts
+        return DisconnectAwareStreamingResponse(
+            upstream_generator(), media_type="text/event-stream", background=BackgroundTask(ticket.release)
+        )
     else:
         try:
             # Track timing measurements
             start_time = time.time()
 
-            upstream = await client.chat.completions.create(
-                messages=request.messages,
-                model=model_name,
-            )
+            ticket = None
+
+            async def call_upstream():
+                # Only the request that makes the upstream call holds a slot, requests that join it do not
+                nonlocal ticket
+                ticket = await admission.acquire(gateway, x_gateway_priority)
+                observe_stage("queue", ticket.queue_time, provider, model_name, x_gateway_id)
+                try:
+                    return await create_completion(routes, request, hedging)
+                finally:
+                    ticket.release()
+
+            coalesce = COALESCE_REQUESTS if x_gateway_coalesce is None else x_gateway_coalesce.lower() == "true"
+            with stage_timer("upstream_response", provider, model_name, x_gateway_id):
+                if coalesce:
+                    request_key = make_request_key(
+                        x_gateway_id, model_name, request.prompt_text, request.params(), api_key
+                    )
+                    ((route, upstream), hedge), coalesced = await single_flight.do(request_key, call_upstream)
+                    CACHE_REQUESTS.inc(cache="coalesce", result="hit" if coalesced else "miss")
+                else:
+                    ((route, upstream), hedge), coalesced = await call_upstream(), False
+            # The request may have been served by a fallback route
+            model_name, provider = route.model, route.provider
             print("Upstream response:", upstream)
             print(upstream.id)
             print("********")
@@ -203,23 +463,25 @@ async def chat_completions(
             
             tokens_prompt = upstream.usage.prompt_tokens
             tokens_completion = upstream.usage.completion_tokens
-            cost_estimate = get_cost(model_name, provider, tokens_prompt, tokens_completion)
+            # Followers of a coalesced call did not cost anything upstream
+            cost_estimate = 0.0 if coalesced else route.cost(tokens_prompt, tokens_completion)
+            reservation.settle(0 if coalesced else tokens_prompt + tokens_completion)
             print(tokens_prompt, tokens_completion, cost_estimate)
 
             # Use timing data from the upstream response
             if hasattr(upstream, 'time_info') and upstream.time_info:
-                queue_time = upstream.time_info.get('queue_time')
                 prompt_time = upstream.time_info.get('prompt_time')
                 completion_time = upstream.time_info.get('completion_time')
                 latency = upstream.time_info.get('total_time')
             else:
                 # Fallback to manual timing if time_info not available
                 latency = time.time() - start_time
-                queue_time = prompt_time = completion_time = None
+                prompt_time = completion_time = None
 
             save_analytics(
                 chat_id=upstream.id,
                 gateway_id=x_gateway_id,
+                gateway=gateway,
                 model=model_name,
                 provider=provider,
                 tokens_prompt=tokens_prompt,
@@ -228,18 +490,24 @@ async def chat_completions(
                 status=True,
                 cost=cost_estimate,
                 latency=latency,
-                queue_time=queue_time,
+                queue_time=ticket.queue_time if ticket else None,
                 prompt_time=prompt_time,
                 completion_time=completion_time,
                 error_message=None,
-                prompt_text=json.dumps([msg.model_dump() if hasattr(msg, 'model_dump') else dict(msg) for msg in request.messages]),
+                prompt_text=request.prompt_text,
                 response_text=assistant_text,
                 http_status_code=200,
-                endpoint="/chat/completions"
+                endpoint="/chat/completions",
+                coalesced=coalesced,
+                saved_cost=route.cost(tokens_prompt, tokens_completion) if coalesced else None,
+                # Hedging is accounted to the request that made the upstream call
+                hedged=hedge.hedged and not coalesced,
+                hedge_won=hedge.won and not coalesced,
+                hedge_wasted_tokens=tokens_prompt if hedge.hedged and not coalesced else 0
             )
                     
     
-            return {
+            response = {
                 "id": upstream.id,
                 "object": "chat.completion",
                 "created": upstream.created,
@@ -261,11 +529,30 @@ async def chat_completions(
                 if hasattr(upstream, "usage")
                 else None,
             }
+            if cache_key:
+                await response_cache.set(cache_key, {
+                    "id": upstream.id,
+                    "model": model_name,
+                    "provider": provider,
+                    "usage": {"prompt_tokens": tokens_prompt, "completion_tokens": tokens_completion},
+                    "cost": route.cost(tokens_prompt, tokens_completion),
+                    "response_text": assistant_text,
+                    "response": response,
+                }, gateway.cache_ttl)
+                if near_namespace:
+                    near_index.add(near_namespace, prompt_fingerprint, cache_key)
+            return response
+        except HTTPException:
+            # No upstream slot, as before the call it is not logged
+            reservation.settle(0)
+            raise
         except Exception as e:
             print(f"Error in non-streaming: {e}")
+            reservation.settle(0)
             error_status_code = extract_status_code_from_error(str(e))
             save_analytics(
                 gateway_id=x_gateway_id,
+                gateway=gateway,
                 model=model_name,
                 provider=provider,
                 tokens_prompt=0,
@@ -274,17 +561,239 @@ async def chat_completions(
                 status=False,
                 cost=0,
                 latency=None,
-                queue_time=None,
+                queue_time=ticket.queue_time if ticket else None,
                 prompt_time=None,
                 completion_time=None,
                 error_message=str(e),
-                prompt_text=json.dumps([msg.model_dump() if hasattr(msg, 'model_dump') else dict(msg) for msg in request.messages]),
+                prompt_text=request.prompt_text,
                 response_text=None,
                 http_status_code=error_status_code,
                 endpoint="/chat/completions"
             )
             return {"error": str(e)}
 
+def serve_cached_response(entry, request, gateway):
+    """Answer from the response cache, logging the hit and the upstream cost it saved"""
+    save_analytics(
+        chat_id=entry["id"],
+        gateway_id=gateway.id,
+        gateway=gateway,
+        model=entry["model"],
+        provider=entry["provider"],
+        tokens_prompt=entry["usage"]["prompt_tokens"],
+        tokens_completion=entry["usage"]["completion_tokens"],
+        request_type="streaming" if request.stream else "non-streaming",
+        status=True,
+        cost=0.0,
+        latency=0.0,
+        error_message=None,
+        prompt_text=request.prompt_text,
+        response_text=entry["response_text"],
+        http_status_code=200,
+        endpoint="/chat/completions",
+        cache_hit=True,
+        saved_cost=entry["cost"]
+    )
+    if "events" in entry:
+        return StreamingResponse(replay_stream(entry), media_type="text/event-stream")
+    return entry["response"]
+
+
+@app.post("/embeddings")
+async def embeddings(
+    request: EmbeddingRequest, authorization: str = Header(None),
+    x_gateway_authorization: str = Header(None, alias="x-gateway-authorization"),
+    x_gateway_id: str = Header(None, alias="x-gateway-id"),
+    x_gateway_priority: str = Header(None, alias="x-gateway-priority"),
+    db=Depends(get_db)
+):
+    api_key = None
+    if authorization and authorization.startswith("Bearer "):
+        api_key = authorization.split(" ")[1]
+
+    # Unlabelled until the gateway and model are known, so callers cannot create series
+    with stage_timer("auth"):
+        gateway = await validate_gateway(x_gateway_id, x_gateway_authorization, db)
+    if not gateway:
+        return {"error": "Invalid Gateway ID or Authorization"}
+
+    route_start = time.perf_counter()
+    routes = resolve_route(request.model, api_key)
+    model_name, provider = routes[0].model, routes[0].provider
+    observe_stage("route", time.perf_counter() - route_start, provider, model_name, x_gateway_id)
+
+    inputs = [request.input] if isinstance(request.input, str) else request.input
+    estimate = sum(len(text) for text in inputs) // 4 + len(inputs)
+    reservation = rate_limiter.acquire(gateway, estimate)
+
+    params = request.model_dump(include={"encoding_format", "dimensions"}, exclude_none=True)
+    start_time = time.time()
+    try:
+        # Small concurrent requests are merged into one upstream call, which alone takes an upstream slot
+        with stage_timer("upstream_response", provider, model_name, x_gateway_id):
+            result = await embedding_batcher.embed(routes, inputs, gateway, x_gateway_priority, **params)
+    except HTTPException:
+        # No upstream slot for the merged call
+        reservation.settle(0)
+        raise
+    except Exception as e:
+        print(f"Error in embeddings: {e}")
+        reservation.settle(0)
+        save_analytics(
+            gateway_id=x_gateway_id,
+            gateway=gateway,
+            model=model_name,
+            provider=provider,
+            request_type="embedding",
+            status=False,
+            error_message=str(e),
+            http_status_code=extract_status_code_from_error(str(e)),
+            endpoint="/embeddings"
+        )
+        return {"error": str(e)}
+
+    route = result.route
+    reservation.settle(result.tokens)
+    save_analytics(
+        gateway_id=x_gateway_id,
+        gateway=gateway,
+        model=route.model,
+        provider=route.provider,
+        tokens_prompt=result.tokens,
+        tokens_completion=0,
+        request_type="embedding",
+        status=True,
+        cost=route.cost(result.tokens, 0),
+        latency=time.time() - start_time,
+        queue_time=result.queue_time,
+        http_status_code=200,
+        endpoint="/embeddings"
+    )
+
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": index, "embedding": embedding}
+            for index, embedding in enumerate(result.embeddings)
+        ],
+        "model": result.model,
+        "usage": {"prompt_tokens": result.tokens, "total_tokens": result.tokens},
+    }
+
+
+@app.post("/batches")
+async def create_batch(
+    http_request: Request, native: bool = Query(False), authorization: str = Header(None),
+    x_gateway_authorization: str = Header(None, alias="x-gateway-authorization"),
+    x_gateway_id: str = Header(None, alias="x-gateway-id"),
+    db=Depends(get_db)
+):
+    """Upload a JSONL file of chat completion requests, run in the background"""
+    api_key = None
+    if authorization and authorization.startswith("Bearer "):
+        api_key = authorization.split(" ")[1]
+
+    gateway = await validate_gateway(x_gateway_id, x_gateway_authorization, db)
+    if not gateway:
+        return {"error": "Invalid Gateway ID or Authorization"}
+
+    return await batch_manager.create(gateway, await http_request.body(), api_key, native)
+
+
+@app.get("/batches")
+async def list_batches(
+    x_gateway_authorization: str = Header(None, alias="x-gateway-authorization"),
+    x_gateway_id: str = Header(None, alias="x-gateway-id"),
+    db=Depends(get_db)
+):
+    gateway = await validate_gateway(x_gateway_id, x_gateway_authorization, db)
+    if not gateway:
+        return {"error": "Invalid Gateway ID or Authorization"}
+
+    return {"batches": batch_manager.list(gateway.id)}
+
+
+@app.get("/batches/{batch_id}")
+async def get_batch(
+    batch_id: str,
+    x_gateway_authorization: str = Header(None, alias="x-gateway-authorization"),
+    x_gateway_id: str = Header(None, alias="x-gateway-id"),
+    db=Depends(get_db)
+):
+    gateway = await validate_gateway(x_gateway_id, x_gateway_authorization, db)
+    if not gateway:
+        return {"error": "Invalid Gateway ID or Authorization"}
+
+    batch = batch_manager.get(batch_id, gateway.id)
+    if not batch:
+        return {"error": "Batch not found"}
+    return batch
+
+
+@app.get("/batches/{batch_id}/output")
+async def get_batch_output(
+    batch_id: str,
+    x_gateway_authorization: str = Header(None, alias="x-gateway-authorization"),
+    x_gateway_id: str = Header(None, alias="x-gateway-id"),
+    db=Depends(get_db)
+):
+    """The results written so far, one JSON line per finished request"""
+    gateway = await validate_gateway(x_gateway_id, x_gateway_authorization, db)
+    if not gateway:
+        return {"error": "Invalid Gateway ID or Authorization"}
+
+    batch = batch_manager.get(batch_id, gateway.id)
+    if not batch or not os.path.exists(batch_manager.output_path(batch_id)):
+        return {"error": "Batch output not found"}
+    return FileResponse(batch_manager.output_path(batch_id), media_type="application/jsonl")
+
+
+@app.post("/batches/{batch_id}/cancel")
+async def cancel_batch(
+    batch_id: str,
+    x_gateway_authorization: str = Header(None, alias="x-gateway-authorization"),
+    x_gateway_id: str = Header(None, alias="x-gateway-id"),
+    db=Depends(get_db)
+):
+    gateway = await validate_gateway(x_gateway_id, x_gateway_authorization, db)
+    if not gateway:
+        return {"error": "Invalid Gateway ID or Authorization"}
+
+    batch = await batch_manager.cancel(batch_id, gateway.id)
+    if not batch:
+        return {"error": "Batch not found"}
+    return batch
+
+
+@app.get("/metrics", dependencies=[Depends(require_admin)])
+async def metrics():
+    """Prometheus text exposition of request stage timings, counters and live gauges, labelled by gateway id"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/admin/catalog", dependencies=[Depends(require_admin)])
+async def get_catalog():
+    """Version and size of the model catalog in use"""
+    return route_catalog.current.summary()
+
+
+@app.post("/admin/catalog/reload", dependencies=[Depends(require_admin)])
+def reload_catalog():
+    """Load the model catalog file again; requests in flight keep the routes they resolved"""
+    try:
+        changed = route_catalog.reload()
+    except CatalogError as e:
+        raise HTTPException(status_code=400, detail=f"Catalog not reloaded, version {route_catalog.current.version} stays in use: {e}")
+    return {"changed": changed, **route_catalog.current.summary()}
+
+
+@app.post("/admin/auth-cache/invalidate", dependencies=[Depends(require_admin)])
+async def invalidate_auth_cache(body: AuthCacheInvalidation):
+    """Drop cached gateways and users changed on another worker or node"""
+    auth_cache.invalidate(gateways=body.gateways, users=body.users, publish=False)
+    return {"gateways": len(body.gateways), "users": len(body.users)}
+
+
 @app.get("/analytics/{gateway_id}")
 async def get_gateway_analytics(
     gateway_id: str,
@@ -303,7 +812,9 @@ async def get_gateway_analytics(
     
     if cache_key in analytics_cache:
         print("cached")
+        CACHE_REQUESTS.inc(cache="analytics", result="hit")
         return analytics_cache[cache_key]
+    CACHE_REQUESTS.inc(cache="analytics", result="miss")
     try:
         from datetime import datetime, timedelta, UTC
         from sqlalchemy import func, text
@@ -350,8 +861,13 @@ async def get_gateway_analytics(
         token_stats = base_query.with_entities(
             func.sum(RequestAnalytics.tokens_prompt).label('total_tokens_in'),
             func.sum(RequestAnalytics.tokens_completion).label('total_tokens_out'),
-            func.sum(RequestAnalytics.cost).label('total_cost')
+            func.sum(RequestAnalytics.cost).label('total_cost'),
+            func.sum(RequestAnalytics.saved_cost).label('saved_cost'),
+            func.sum(RequestAnalytics.hedge_wasted_tokens).label('hedge_wasted_tokens')
         ).first()
+        cache_hits = base_query.filter(RequestAnalytics.cache_hit == True).count()
+        hedges_fired = base_query.filter(RequestAnalytics.hedged == True).count()
+        hedges_won = base_query.filter(RequestAnalytics.hedge_won == True).count()
 
         # Latency statistics (only for successful requests)
         latency_stats = base_query.filter(
@@ -363,6 +879,14 @@ async def get_gateway_analytics(
             func.max(RequestAnalytics.latency).label('max_latency')
         ).first()
 
+        # Streaming timings (NULL for non-streaming requests, so avg skips them)
+        stream_stats = base_query.filter(RequestAnalytics.status == True).with_entities(
+            func.avg(RequestAnalytics.ttft).label('avg_ttft'),
+            func.avg(RequestAnalytics.itl_mean).label('avg_itl'),
+            func.avg(RequestAnalytics.itl_p95).label('avg_itl_p95'),
+            func.avg(RequestAnalytics.tokens_per_second).label('avg_tokens_per_second')
+        ).first()
+
         # Error statistics
         error_count = base_query.filter(RequestAnalytics.status == False).count()
         error_rate = (error_count / total_requests) * 100 if total_requests > 0 else 0
@@ -374,7 +898,11 @@ async def get_gateway_analytics(
             func.sum(RequestAnalytics.tokens_prompt).label('tokens_in'),
             func.sum(RequestAnalytics.tokens_completion).label('tokens_out'),
             func.sum(RequestAnalytics.cost).label('cost'),
-            func.avg(RequestAnalytics.latency).label('avg_latency')
+            func.avg(RequestAnalytics.latency).label('avg_latency'),
+            func.avg(RequestAnalytics.ttft).label('avg_ttft'),
+            func.avg(RequestAnalytics.itl_mean).label('avg_itl'),
+            func.avg(RequestAnalytics.itl_p95).label('avg_itl_p95'),
+            func.avg(RequestAnalytics.tokens_per_second).label('avg_tokens_per_second')
         ).group_by(RequestAnalytics.model).all()
 
         # Format model breakdown
@@ -386,7 +914,11 @@ async def get_gateway_analytics(
                 "tokens_out": model_stat.tokens_out or 0,
                 "total_tokens": (model_stat.tokens_in or 0) + (model_stat.tokens_out or 0),
                 "cost": float(model_stat.cost or 0),
-                "avg_latency": float(model_stat.avg_latency or 0) if model_stat.avg_latency else 0
+                "avg_latency": float(model_stat.avg_latency or 0) if model_stat.avg_latency else 0,
+                "avg_ttft": float(model_stat.avg_ttft or 0),
+                "avg_inter_token_latency": float(model_stat.avg_itl or 0),
+                "avg_p95_inter_token_latency": float(model_stat.avg_itl_p95 or 0),
+                "avg_tokens_per_second": float(model_stat.avg_tokens_per_second or 0)
             }
 
         # Daily statistics for the requested time range
@@ -424,6 +956,13 @@ async def get_gateway_analytics(
         logs = []
         if include_logs:
             log_records = base_query.order_by(RequestAnalytics.timestamp.desc()).all()
+            # Message and response bodies are stored once each and shared between rows
+            bodies = load_bodies(session, {
+                digest
+                for record in log_records
+                for digest in [*(record.prompt_hashes or []), record.response_hash]
+                if digest
+            })
 
             for record in log_records:
                 log_entry = {
@@ -444,10 +983,24 @@ async def get_gateway_analytics(
                     "prompt_time": float(record.prompt_time) if record.prompt_time else None,
                     "completion_time": float(record.completion_time) if record.completion_time else None,
                     "error_message": record.error_message,
-                    "prompt_text": record.prompt_text,
-                    "response_text": record.response_text,
+                    "prompt_text": record.prompt_text or (
+                        prompt_from_bodies(record.prompt_hashes, bodies) if record.prompt_hashes else None
+                    ),
+                    "response_text": record.response_text or bodies.get(record.response_hash),
                     "http_status_code": record.http_status_code,
-                    "endpoint": record.endpoint
+                    "endpoint": record.endpoint,
+                    "ttft": record.ttft,
+                    "itl_mean": record.itl_mean,
+                    "itl_p95": record.itl_p95,
+                    "tokens_per_second": record.tokens_per_second,
+                    "coalesced": record.coalesced,
+                    "cache_hit": record.cache_hit,
+                    "saved_cost": record.saved_cost,
+                    "hedged": record.hedged,
+                    "hedge_won": record.hedge_won,
+                    "hedge_wasted_tokens": record.hedge_wasted_tokens,
+                    "capture_reason": record.capture_reason,
+                    "sample_weight": record.sample_weight
                 }
                 logs.append(log_entry)
 
@@ -465,9 +1018,18 @@ async def get_gateway_analytics(
                 "tokens_out": token_stats.total_tokens_out or 0,
                 "total_tokens": (token_stats.total_tokens_in or 0) + (token_stats.total_tokens_out or 0),
                 "total_cost": float(token_stats.total_cost or 0),
+                "saved_cost": float(token_stats.saved_cost or 0),
+                "cache_hits": cache_hits,
+                "hedges_fired": hedges_fired,
+                "hedges_won": hedges_won,
+                "hedge_wasted_tokens": token_stats.hedge_wasted_tokens or 0,
                 "avg_latency": float(latency_stats.avg_latency or 0) if latency_stats.avg_latency else 0,
                 "min_latency": float(latency_stats.min_latency or 0) if latency_stats.min_latency else 0,
                 "max_latency": float(latency_stats.max_latency or 0) if latency_stats.max_latency else 0,
+                "avg_ttft": float(stream_stats.avg_ttft or 0),
+                "avg_inter_token_latency": float(stream_stats.avg_itl or 0),
+                "avg_p95_inter_token_latency": float(stream_stats.avg_itl_p95 or 0),
+                "avg_tokens_per_second": float(stream_stats.avg_tokens_per_second or 0),
                 "error_count": error_count,
                 "error_rate": round(error_rate, 2),
                 "success_rate": round(100 - error_rate, 2),
@@ -497,7 +1059,8 @@ async def create_gateway(body: GatewayCreate, current_user: User = Depends(get_c
 
     gw = Gateway(id=gateway_id, name=body.name, secret_key=secret, user_id=current_user.id)
     db.add(gw)
-    db.commit()
+    await db.commit()
+    auth_cache.invalidate(gateways=[gateway_id])
 
     return {
         "gateway_id": gateway_id,
@@ -506,7 +1069,7 @@ async def create_gateway(body: GatewayCreate, current_user: User = Depends(get_c
 
 @app.get("/gateway/list")
 async def list_gateways(current_user: User = Depends(get_current_user), db=Depends(get_db)):
-    gateways = db.query(Gateway).filter(Gateway.user_id == current_user.id).all()
+    gateways = (await db.scalars(select(Gateway).where(Gateway.user_id == current_user.id))).all()
     result = []
     for gw in gateways:
         result.append({
@@ -518,10 +1081,10 @@ async def list_gateways(current_user: User = Depends(get_current_user), db=Depen
 
 @app.get("/gateway/{gateway_id}/credentials")
 async def get_gateway_credentials(gateway_id: str, current_user: User = Depends(get_current_user), db=Depends(get_db)):
-    gateway = db.query(Gateway).filter(
+    gateway = await db.scalar(select(Gateway).where(
         Gateway.id == gateway_id,
         Gateway.user_id == current_user.id
-    ).first()
+    ))
 
     if not gateway:
         return {"error": "Gateway not found"}
@@ -536,10 +1099,10 @@ async def get_gateway_credentials(gateway_id: str, current_user: User = Depends(
 async def regenerate_gateway_secret(gateway_id: str, current_user: User = Depends(get_current_user), db=Depends(get_db)):
     from uuid import uuid4
 
-    gateway = db.query(Gateway).filter(
+    gateway = await db.scalar(select(Gateway).where(
         Gateway.id == gateway_id,
         Gateway.user_id == current_user.id
-    ).first()
+    ))
 
     if not gateway:
         return {"error": "Gateway not found"}
@@ -547,7 +1110,9 @@ async def regenerate_gateway_secret(gateway_id: str, current_user: User = Depend
     # Generate new secret
     new_secret = str(uuid4())
     gateway.secret_key = new_secret
-    db.commit()
+    await db.commit()
+    # The old secret stops working right away, on this worker and its peers
+    auth_cache.invalidate(gateways=[gateway.id])
 
     return {
         "gateway_id": gateway.id,
@@ -556,20 +1121,68 @@ async def regenerate_gateway_secret(gateway_id: str, current_user: User = Depend
     }
     
 
+def gateway_settings_response(gateway):
+    return {
+        "gateway_id": gateway.id,
+        "cache_enabled": gateway.cache_enabled,
+        "cache_ttl": gateway.cache_ttl,
+        "near_cache_threshold": gateway.near_cache_threshold,
+        "hedging_enabled": gateway.hedging_enabled,
+        "rpm_limit": gateway.rpm_limit,
+        "tpm_limit": gateway.tpm_limit,
+        "queue_weight": gateway.queue_weight,
+        "capture_sample_rate": gateway.capture_sample_rate,
+        "capture_latency_threshold": gateway.capture_latency_threshold,
+        "capture_cost_threshold": gateway.capture_cost_threshold,
+    }
+
+
+@app.get("/gateway/{gateway_id}/settings")
+async def get_gateway_settings(gateway_id: str, current_user: User = Depends(get_current_user), db=Depends(get_db)):
+    gateway = await db.scalar(select(Gateway).where(
+        Gateway.id == gateway_id,
+        Gateway.user_id == current_user.id
+    ))
+
+    if not gateway:
+        return {"error": "Gateway not found"}
+
+    return gateway_settings_response(gateway)
+
+
+@app.post("/gateway/{gateway_id}/settings")
+async def update_gateway_settings(gateway_id: str, body: GatewaySettings, current_user: User = Depends(get_current_user), db=Depends(get_db)):
+    gateway = await db.scalar(select(Gateway).where(
+        Gateway.id == gateway_id,
+        Gateway.user_id == current_user.id
+    ))
+
+    if not gateway:
+        return {"error": "Gateway not found"}
+
+    # Only fields present in the request body are changed
+    for field, value in body.model_dump(exclude_unset=True).items():
+        setattr(gateway, field, value)
+    await db.commit()
+    auth_cache.invalidate(gateways=[gateway.id])
+
+    return gateway_settings_response(gateway)
+
+
 @app.post("/auth/join")
-def join(db=Depends(get_db)):
+async def join(db=Depends(get_db)):
     # Generate unique user ID and username
     user_id = str(uuid.uuid4())
     username = generate_username()
 
     # Ensure username is unique
-    while db.query(User).filter(User.username == username).first():
+    while await db.scalar(select(User.id).where(User.username == username)):
         username = generate_username()
 
     # Create and save user to database
     user = User(id=user_id, username=username)
     db.add(user)
-    db.commit()
+    await db.commit()
 
     return {"id": user_id, "username": username}
     
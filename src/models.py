@@ -1,6 +1,6 @@
-from typing import Optional, List
+from typing import Optional, List, Union
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 # data models
@@ -17,5 +17,30 @@ class ChatCompletionRequest(BaseModel):
     stream: Optional[bool] = False
 
 
+class EmbeddingRequest(BaseModel):
+    model: str
+    input: Union[str, List[str]]
+    encoding_format: Optional[str] = None
+    dimensions: Optional[int] = None
+
+
 class GatewayCreate(BaseModel):
     name: str
+
+
+class GatewaySettings(BaseModel):
+    cache_enabled: Optional[bool] = None
+    cache_ttl: Optional[int] = None
+    near_cache_threshold: Optional[float] = Field(default=None, ge=0, le=1)
+    hedging_enabled: Optional[bool] = None
+    rpm_limit: Optional[int] = Field(default=None, ge=1)
+    tpm_limit: Optional[int] = Field(default=None, ge=1)
+    queue_weight: Optional[float] = Field(default=None, gt=0)
+    capture_sample_rate: Optional[float] = Field(default=None, ge=0, le=1)
+    capture_latency_threshold: Optional[float] = Field(default=None, ge=0)
+    capture_cost_threshold: Optional[float] = Field(default=None, ge=0)
+
+
+class AuthCacheInvalidation(BaseModel):
+    gateways: List[str] = []
+    users: List[str] = []
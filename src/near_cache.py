@@ -0,0 +1,163 @@
+import heapq
+import os
+import re
+from collections import OrderedDict
+
+from metrics import CallbackMetric
+from raw_request import message_text
+
+NEAR_CACHE_MAX_ENTRIES = int(os.getenv("NEAR_CACHE_MAX_ENTRIES", "10000"))
+# Fingerprints are split into bands for the LSH index; any pair within
+# NEAR_CACHE_BANDS - 1 differing bits is guaranteed to share a band
+NEAR_CACHE_BANDS = int(os.getenv("NEAR_CACHE_BANDS", "8"))
+SKETCH_SIZE = 32
+MAX_FEATURES = 2048
+
+_MASK64 = (1 << 64) - 1
+
+# Tokens that change on every request without changing the question: ISO
+# dates and timestamps, UUIDs and long hex ids. Other numbers are kept, since
+# "17 * 23" and "91 * 42" are different prompts
+_VOLATILE = re.compile(r"""
+    \b(?:
+        \d{4}-\d{2}-\d{2}(?:[t\ ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:z|[+-]\d{2}:?\d{2})?)?
+        | [0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12}
+        | (?=[0-9a-f]*\d)[0-9a-f]{16,}
+    )\b
+""", re.VERBOSE)
+
+
+class Fingerprint:
+    __slots__ = ("simhash", "sketch")
+
+    def __init__(self, simhash, sketch):
+        self.simhash = simhash
+        self.sketch = sketch
+
+
+def normalize(text):
+    """Lowercased words with volatile words masked, ignoring whitespace differences"""
+    return _VOLATILE.sub("#", text.lower()).split()
+
+
+def _simhash(hashes):
+    # Bit-sliced counters: planes[k] holds bit k of the count of every bit position
+    planes = []
+    for carry in hashes:
+        for k, plane in enumerate(planes):
+            planes[k] = plane ^ carry
+            carry &= plane
+            if not carry:
+                break
+        if carry:
+            planes.append(carry)
+
+    half = len(hashes) / 2
+    simhash = 0
+    for bit in range(64):
+        count = 0
+        for k, plane in enumerate(planes):
+            count |= ((plane >> bit) & 1) << k
+        if count > half:
+            simhash |= 1 << bit
+    return simhash
+
+
+def fingerprint(messages):
+    """SimHash over word trigrams of the normalized conversation, plus a bottom-k MinHash sketch"""
+    words = []
+    for msg in messages:
+        words.append(f"<{msg['role']}>")
+        words.extend(normalize(message_text(msg)))
+    shingles = set(zip(words, words[1:], words[2:])) or {tuple(words)}
+    # hash() is salted per process, which is fine for an in-process index
+    hashes = [hash(shingle) & _MASK64 for shingle in shingles]
+    if len(hashes) > MAX_FEATURES:
+        hashes = heapq.nsmallest(MAX_FEATURES, hashes)
+    return Fingerprint(_simhash(hashes), tuple(heapq.nsmallest(SKETCH_SIZE, hashes)))
+
+
+def estimate_similarity(a, b):
+    """Jaccard similarity estimated from two bottom-k sketches"""
+    union = heapq.nsmallest(SKETCH_SIZE, set(a.sketch) | set(b.sketch))
+    if not union:
+        return 1.0
+    shared = set(a.sketch) & set(b.sketch)
+    return sum(1 for value in union if value in shared) / len(union)
+
+
+class NearDuplicateIndex:
+    """
+    LSH index from prompt fingerprints to response cache keys. A candidate is
+    only returned if its SimHash is within the threshold and its MinHash
+    sketch confirms the similarity; candidates rejected by the sketch are
+    counted as false positives.
+    """
+
+    def __init__(self, max_entries=NEAR_CACHE_MAX_ENTRIES, bands=NEAR_CACHE_BANDS):
+        self.max_entries = max_entries
+        self.bands = bands
+        self.band_bits = 64 // bands
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self.false_positives = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _band_keys(self, namespace, simhash):
+        mask = (1 << self.band_bits) - 1
+        return [(namespace, band, (simhash >> (band * self.band_bits)) & mask) for band in range(self.bands)]
+
+    def lookup(self, namespace, fp, threshold):
+        """Returns (cache_key, similarity) of the closest stored prompt, or (None, 0.0)"""
+        max_distance = int((1 - threshold) * 64)
+        candidates = set()
+        for band_key in self._band_keys(namespace, fp.simhash):
+            candidates.update(self._buckets.get(band_key, ()))
+
+        best_key, best_similarity = None, 0.0
+        for cache_key in candidates:
+            _, other = self._entries[cache_key]
+            if (fp.simhash ^ other.simhash).bit_count() > max_distance:
+                continue
+            similarity = estimate_similarity(fp, other)
+            if similarity < threshold:
+                self.false_positives += 1
+                continue
+            if similarity > best_similarity:
+                best_key, best_similarity = cache_key, similarity
+        if best_key:
+            self._entries.move_to_end(best_key)
+        return best_key, best_similarity
+
+    def add(self, namespace, fp, cache_key):
+        self.discard(cache_key)
+        self._entries[cache_key] = (namespace, fp)
+        for band_key in self._band_keys(namespace, fp.simhash):
+            self._buckets.setdefault(band_key, set()).add(cache_key)
+        while len(self._entries) > self.max_entries:
+            self.discard(next(iter(self._entries)))
+
+    def discard(self, cache_key):
+        item = self._entries.pop(cache_key, None)
+        if item is None:
+            return
+        namespace, fp = item
+        for band_key in self._band_keys(namespace, fp.simhash):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(cache_key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+
+near_index = NearDuplicateIndex()
+
+CallbackMetric("gateway_near_cache_entries", "Prompts in the near-duplicate index", lambda: len(near_index))
+CallbackMetric(
+    "gateway_near_cache_false_positives_total",
+    "Near-duplicate candidates rejected by the MinHash check",
+    lambda: near_index.false_positives,
+    metric_type="counter",
+)
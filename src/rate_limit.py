@@ -0,0 +1,114 @@
+import math
+import os
+import time
+
+from fastapi import HTTPException
+
+from metrics import Counter
+
+# Completion tokens assumed for requests that do not set max_tokens
+RATE_LIMIT_DEFAULT_COMPLETION_TOKENS = int(os.getenv("RATE_LIMIT_DEFAULT_COMPLETION_TOKENS", "512"))
+
+RATE_LIMITED = Counter("gateway_rate_limited_total", "Requests rejected by gateway rate limits", ("gateway", "limit"))
+
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity, period=60.0):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount, now):
+        """Returns 0 if amount was taken, otherwise the seconds until it would be"""
+        self._refill(now)
+        # A single request larger than the whole bucket is let through once it is full
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            self.tokens -= amount
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def give(self, amount):
+        # Negative amounts put the bucket in debt, delaying the next requests
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def estimate_prompt_tokens(prompt_text):
+    """Rough prompt size at ~4 characters per token of the messages' JSON"""
+    return len(prompt_text) // 4
+
+
+def estimate_tokens(prompt_text, max_tokens=None):
+    """Rough upper estimate of a request's tokens: the prompt plus the completion budget"""
+    return estimate_prompt_tokens(prompt_text) + (max_tokens or RATE_LIMIT_DEFAULT_COMPLETION_TOKENS)
+
+
+class Reservation:
+    """Tokens debited up front for one request, settled against its real usage"""
+
+    __slots__ = ("bucket", "estimate", "settled")
+
+    def __init__(self, bucket, estimate):
+        self.bucket = bucket
+        self.estimate = estimate
+        self.settled = False
+
+    def settle(self, tokens):
+        if self.settled or self.bucket is None:
+            return
+        self.settled = True
+        self.bucket.give(self.estimate - tokens)
+
+
+class GatewayRateLimiter:
+    """
+    Per-gateway RPM and TPM limits from the gateway row, enforced with
+    in-memory token buckets. Each worker process enforces its own limits.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+
+    def _bucket(self, gateway_id, kind, limit):
+        key = (gateway_id, kind)
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.capacity != limit:
+            # New gateway, or its limit was changed in the settings
+            bucket = self._buckets[key] = TokenBucket(limit)
+        return bucket
+
+    def acquire(self, gateway, estimate):
+        """Debit one request and its estimated tokens, or raise a 429"""
+        now = time.monotonic()
+        requests = tokens = None
+        if gateway.rpm_limit:
+            requests = self._bucket(gateway.id, "requests", gateway.rpm_limit)
+            wait = requests.take(1, now)
+            if wait:
+                self._reject(gateway.id, "rpm", wait)
+        if gateway.tpm_limit:
+            tokens = self._bucket(gateway.id, "tokens", gateway.tpm_limit)
+            wait = tokens.take(estimate, now)
+            if wait:
+                if requests is not None:
+                    requests.give(1)
+                self._reject(gateway.id, "tpm", wait)
+        return Reservation(tokens, estimate)
+
+    def _reject(self, gateway_id, limit, wait):
+        RATE_LIMITED.inc(gateway=gateway_id, limit=limit)
+        raise HTTPException(
+            429,
+            f"Gateway {limit.upper()} limit exceeded",
+            headers={"Retry-After": str(max(1, math.ceil(wait)))},
+        )
+
+
+rate_limiter = GatewayRateLimiter()
@@ -0,0 +1,177 @@
+import json
+import re
+
+from fastapi import HTTPException
+
+from models import ChatCompletionRequest
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+# Gateway-side defaults for fields the caller left out, the same as ChatCompletionRequest's.
+# They are only used for routing, limits and caching; the upstream gets the body as sent.
+DEFAULTS = {name: field.default for name, field in ChatCompletionRequest.model_fields.items() if name != "messages"}
+
+
+def scan_object(text):
+    """
+    Top-level fields of a JSON object as {key: (value, start, end)}, where
+    text[start:end] is the value's original JSON. Each value is decoded once.
+    """
+    index = _WHITESPACE.match(text, 0).end()
+    if text[index:index + 1] != "{":
+        raise ValueError("Expecting a JSON object")
+    index = _WHITESPACE.match(text, index + 1).end()
+    fields = {}
+    if text[index:index + 1] == "}":
+        index += 1
+    else:
+        while True:
+            key, index = _decoder.raw_decode(text, index)
+            if not isinstance(key, str):
+                raise ValueError(f"Expecting a property name at {index}")
+            index = _WHITESPACE.match(text, index).end()
+            if text[index:index + 1] != ":":
+                raise ValueError(f"Expecting ':' at {index}")
+            start = _WHITESPACE.match(text, index + 1).end()
+            value, end = _decoder.raw_decode(text, start)
+            fields[key] = (value, start, end)
+            index = _WHITESPACE.match(text, end).end()
+            separator = text[index:index + 1]
+            index = _WHITESPACE.match(text, index + 1).end()
+            if separator == "}":
+                break
+            if separator != ",":
+                raise ValueError(f"Expecting ',' or '}}' at {index}")
+    if _WHITESPACE.match(text, index).end() != len(text):
+        raise ValueError(f"Extra data at {index}")
+    return fields
+
+
+def scan_array(text):
+    """The original JSON of each element of a JSON array"""
+    index = _WHITESPACE.match(text, 0).end()
+    if text[index:index + 1] != "[":
+        raise ValueError("Expecting a JSON array")
+    index = _WHITESPACE.match(text, index + 1).end()
+    elements = []
+    if text[index:index + 1] == "]":
+        index += 1
+    else:
+        while True:
+            _, end = _decoder.raw_decode(text, index)
+            elements.append(text[index:end])
+            index = _WHITESPACE.match(text, end).end()
+            separator = text[index:index + 1]
+            index = _WHITESPACE.match(text, index + 1).end()
+            if separator == "]":
+                break
+            if separator != ",":
+                raise ValueError(f"Expecting ',' or ']' at {index}")
+    if _WHITESPACE.match(text, index).end() != len(text):
+        raise ValueError(f"Extra data at {index}")
+    return elements
+
+
+def message_text(message):
+    """The text of a message, whether its content is a string or a list of parts"""
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return " ".join(part.get("text") or "" for part in content if isinstance(part, dict))
+    return ""
+
+
+class RawChatRequest:
+    """
+    A chat completion request kept as the caller's JSON. Only the fields the
+    gateway acts on are validated; the body is forwarded upstream as sent
+    (with the model name rewritten), so unknown OpenAI parameters pass
+    through, and the messages are logged from the original text.
+    """
+
+    __slots__ = ("text", "fields")
+
+    def __init__(self, text):
+        try:
+            self.fields = scan_object(text)
+        except ValueError as e:
+            raise HTTPException(400, f"Invalid JSON body: {e}")
+        self.text = text
+        self._validate()
+
+    @classmethod
+    def from_bytes(cls, raw):
+        try:
+            return cls(raw.decode("utf-8"))
+        except UnicodeDecodeError:
+            raise HTTPException(400, "Request body is not valid UTF-8")
+
+    def _validate(self):
+        messages = self.get("messages")
+        if not isinstance(messages, list) or not all(isinstance(msg, dict) and isinstance(msg.get("role"), str) for msg in messages):
+            raise HTTPException(400, "messages must be a list of objects with a role")
+        if not isinstance(self.model, str) or not self.model:
+            raise HTTPException(400, "model must be a non-empty string")
+        if not isinstance(self.get("stream"), (bool, type(None))):
+            raise HTTPException(400, "stream must be a boolean")
+        if self.max_tokens is not None and (not isinstance(self.max_tokens, int) or isinstance(self.max_tokens, bool)):
+            raise HTTPException(400, "max_tokens must be an integer")
+        if self.temperature is not None and (not isinstance(self.temperature, (int, float)) or isinstance(self.temperature, bool)):
+            raise HTTPException(400, "temperature must be a number")
+
+    def get(self, name, default=None):
+        field = self.fields.get(name)
+        if field is None:
+            return DEFAULTS.get(name, default)
+        return field[0]
+
+    @property
+    def model(self):
+        return self.get("model")
+
+    @property
+    def messages(self):
+        return self.get("messages")
+
+    @property
+    def stream(self):
+        return bool(self.get("stream"))
+
+    @property
+    def max_tokens(self):
+        return self.get("max_tokens")
+
+    @property
+    def temperature(self):
+        return self.get("temperature")
+
+    @property
+    def prompt_text(self):
+        """The messages exactly as the caller sent them"""
+        _, start, end = self.fields["messages"]
+        return self.text[start:end]
+
+    def params(self):
+        """Every field besides the model and messages, which can change the upstream response"""
+        params = {name: value for name, (value, _, _) in self.fields.items() if name not in ("model", "messages")}
+        params["stream"] = self.stream
+        return params
+
+    def body(self, **overrides):
+        """The original JSON as bytes, with the given top-level fields replaced or added"""
+        replaced = sorted((self.fields[name][1:], value) for name, value in overrides.items() if name in self.fields)
+        added = [f"{json.dumps(name)}:{json.dumps(value)}" for name, value in overrides.items() if name not in self.fields]
+
+        parts = []
+        index = 0
+        if added:
+            brace = self.text.index("{") + 1
+            parts += [self.text[:brace], ",".join(added), "," if self.fields else ""]
+            index = brace
+        for (start, end), value in replaced:
+            parts += [self.text[index:start], json.dumps(value)]
+            index = end
+        parts.append(self.text[index:])
+        return "".join(parts).encode()
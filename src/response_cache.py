@@ -0,0 +1,126 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from metrics import CallbackMetric
+
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Optional second tier on disk, shared across restarts and workers
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR")
+
+
+class ResponseCache:
+    """
+    Exact-match completion cache. Entries are plain dicts: either a full
+    non-streaming response or the list of SSE event payloads of a stream,
+    along with the usage and cost of the original upstream call.
+    """
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES, ttl=RESPONSE_CACHE_TTL, directory=RESPONSE_CACHE_DIR):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.size = 0
+        self._entries = OrderedDict()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _store(self, key, entry, size, expires_at):
+        self._discard(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (expires_at, size, entry)
+        self.size += size
+        while self.size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._discard(oldest)
+
+    def _discard(self, key):
+        item = self._entries.pop(key, None)
+        if item:
+            self.size -= item[1]
+
+    async def get(self, key):
+        item = self._entries.get(key)
+        if item:
+            if item[0] > time.time():
+                self._entries.move_to_end(key)
+                return item[2]
+            self._discard(key)
+
+        if not self.directory:
+            return None
+        raw = await asyncio.to_thread(self._read_file, key)
+        if raw is None:
+            return None
+        stored = json.loads(raw)
+        if stored["expires_at"] <= time.time():
+            await asyncio.to_thread(self._remove_file, key)
+            return None
+        # Promote disk hits to memory
+        self._store(key, stored["entry"], len(raw), stored["expires_at"])
+        return stored["entry"]
+
+    async def set(self, key, entry, ttl=None):
+        expires_at = time.time() + (ttl or self.ttl)
+        raw = json.dumps({"expires_at": expires_at, "entry": entry})
+        self._store(key, entry, len(raw), expires_at)
+        if self.directory:
+            try:
+                await asyncio.to_thread(self._write_file, key, raw)
+            except OSError as e:
+                logging.error(f"Failed to write response cache entry: {e}")
+
+    def _read_file(self, key):
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_file(self, key, raw):
+        # Write then rename, so readers never see a partial entry
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(raw)
+        os.replace(tmp_path, path)
+
+    def _remove_file(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+def is_cacheable(gateway, temperature, cache_header=None):
+    """Deterministic requests are cached: temperature 0, or the caller asked for it"""
+    if not gateway.cache_enabled:
+        return False
+    cache_header = (cache_header or "").lower()
+    if cache_header in ("false", "no-cache", "no-store"):
+        return False
+    return temperature == 0 or cache_header == "true"
+
+
+async def replay_stream(entry):
+    """Replay a cached stream as SSE, the same way it was first served"""
+    for payload in entry["events"]:
+        yield f"data: {payload}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+response_cache = ResponseCache()
+
+CallbackMetric("gateway_response_cache_bytes", "Bytes held by the in-memory response cache", lambda: response_cache.size)
+CallbackMetric("gateway_response_cache_entries", "Entries in the in-memory response cache", lambda: len(response_cache))
@@ -0,0 +1,127 @@
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import orjson
+
+# Payload length and CRC32 in front of every record
+_HEADER = struct.Struct("<II")
+
+
+class Spool:
+    """
+    Records kept on local disk until they can be written elsewhere.
+
+    Records are JSON documents appended to numbered segment files, each one
+    framed by its length and CRC32. A batch of records is written with a
+    single write and fsync. A segment is closed once it reaches
+    segment_bytes. When the segments together exceed max_bytes, the oldest
+    one is deleted. Readers map closed segments into memory and stop at the
+    first torn or corrupt record, so a crash mid-write loses only the batch
+    that was being written.
+    """
+
+    def __init__(self, directory, segment_bytes, max_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._segments = sorted(
+            int(name[len("segment-"):-len(".log")])
+            for name in os.listdir(directory)
+            if name.startswith("segment-") and name.endswith(".log")
+        )
+        self._sizes = {number: os.path.getsize(self._path(number)) for number in self._segments}
+        self._file = None
+
+    def _path(self, number):
+        return os.path.join(self.directory, f"segment-{number:012d}.log")
+
+    def __len__(self):
+        return len(self._segments)
+
+    def size(self):
+        return sum(self._sizes.values())
+
+    def append(self, records):
+        """Write records durably, returns how many older records were dropped to stay under max_bytes"""
+        data = bytearray()
+        for record in records:
+            payload = orjson.dumps(record)
+            data += _HEADER.pack(len(payload), zlib.crc32(payload))
+            data += payload
+        with self._lock:
+            if self._file is None or self._sizes[self._segments[-1]] >= self.segment_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._sizes[self._segments[-1]] += len(data)
+            return self._trim()
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        number = self._segments[-1] + 1 if self._segments else 1
+        self._file = open(self._path(number), "ab")
+        self._segments.append(number)
+        self._sizes[number] = 0
+
+    def _trim(self):
+        dropped = 0
+        # The segment being written is never trimmed
+        while len(self._segments) > 1 and self.size() > self.max_bytes:
+            number = self._segments.pop(0)
+            dropped += sum(1 for _ in self._records(self._path(number)))
+            self._sizes.pop(number)
+            self._unlink(self._path(number))
+        return dropped
+
+    def seal(self):
+        """Close the segment being written and return the paths of all segments, oldest first"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            return [self._path(number) for number in self._segments]
+
+    def read(self, path):
+        """The records of a sealed segment"""
+        return self._records(path)
+
+    def _records(self, path):
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    offset = 0
+                    while offset + _HEADER.size <= len(data):
+                        length, checksum = _HEADER.unpack_from(data, offset)
+                        payload = data[offset + _HEADER.size:offset + _HEADER.size + length]
+                        if len(payload) < length or zlib.crc32(payload) != checksum:
+                            break
+                        yield orjson.loads(payload)
+                        offset += _HEADER.size + length
+        except FileNotFoundError:
+            # Trimmed while it was waiting to be read
+            return
+
+    def remove(self, path):
+        """Delete a segment once its records are written"""
+        with self._lock:
+            number = int(os.path.basename(path)[len("segment-"):-len(".log")])
+            if number in self._sizes and not (self._file is not None and number == self._segments[-1]):
+                self._segments.remove(number)
+                self._sizes.pop(number)
+                self._unlink(path)
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,148 @@
+import json
+import math
+import os
+import time
+
+# Forward upstream SSE bytes unchanged instead of re-serializing every chunk
+SSE_PASSTHROUGH = os.getenv("SSE_PASSTHROUGH", "true").lower() == "true"
+
+
+class StreamError(Exception):
+    """An error event the provider sent inside an otherwise successful stream"""
+
+
+def _has_value(payload, key):
+    """Whether a chunk carries a non-empty value for key, without decoding it"""
+    index = payload.find(key)
+    if index == -1:
+        return False
+    value = payload[index + len(key):index + len(key) + 9].lstrip(b": \t")
+    return bool(value) and not value.startswith((b"null", b'""'))
+
+
+def _has_usage(payload):
+    return _has_value(payload, b'"usage"')
+
+
+class StreamTimings:
+    """
+    Cheap per-chunk timing for a streamed response: time to first token,
+    inter-chunk gaps and decode throughput.
+    """
+
+    def __init__(self, start=None):
+        self.start = start if start is not None else time.perf_counter()
+        self.first_token = None
+        self.last_chunk = None
+        self.gaps = []
+
+    def chunk(self, now=None):
+        now = now if now is not None else time.perf_counter()
+        if self.last_chunk is not None:
+            self.gaps.append(now - self.last_chunk)
+        self.last_chunk = now
+
+    def token(self, now=None):
+        if self.first_token is None:
+            self.first_token = now if now is not None else time.perf_counter()
+
+    def summary(self, tokens_completion=0):
+        ttft = self.first_token - self.start if self.first_token is not None else None
+        itl_mean = itl_p95 = tokens_per_second = None
+        if self.gaps:
+            gaps = sorted(self.gaps)
+            itl_mean = sum(gaps) / len(gaps)
+            itl_p95 = gaps[min(len(gaps) - 1, math.ceil(0.95 * len(gaps)) - 1)]
+        if self.first_token is not None and self.last_chunk is not None and tokens_completion:
+            decode_time = self.last_chunk - self.first_token
+            if decode_time > 0:
+                tokens_per_second = tokens_completion / decode_time
+        return {"ttft": ttft, "itl_mean": itl_mean, "itl_p95": itl_p95, "tokens_per_second": tokens_per_second}
+
+
+class SSEScanner:
+    """
+    Incremental scanner over raw chat completion SSE bytes. It only decodes
+    the few events the gateway needs on the hot path (the first chunk for its
+    id, usage and error events); content deltas are decoded once the stream
+    has finished. With keep_payloads every payload is kept, to replay the
+    stream from the response cache, otherwise only those with content.
+    """
+
+    def __init__(self, timings=None, keep_payloads=False):
+        self.timings = timings
+        self.keep_payloads = keep_payloads
+        self._buffer = b""
+        self.payloads = []
+        self.chat_id = None
+        self.usage = None
+        self.time_info = None
+        self.error = None
+        self.done = False
+        self.events = 0
+
+    def feed(self, data):
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n")
+        self._buffer += data
+        start = 0
+        while True:
+            end = self._buffer.find(b"\n\n", start)
+            if end == -1:
+                break
+            self._scan_event(self._buffer[start:end])
+            start = end + 2
+        if start:
+            self._buffer = self._buffer[start:]
+
+    def _scan_event(self, event):
+        for line in event.split(b"\n"):
+            # Comment lines (": keep-alive") and other fields are passed through untouched
+            if not line.startswith(b"data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == b"[DONE]":
+                self.done = True
+                continue
+            if not payload:
+                continue
+
+            self.events += 1
+            if self.keep_payloads or b'"content"' in payload:
+                self.payloads.append(payload)
+            if self.timings and self.timings.first_token is None and _has_value(payload, b'"content"'):
+                self.timings.token()
+            if self.chat_id is None or b'"error"' in payload or b'"time_info"' in payload or _has_usage(payload):
+                self._scan_payload(payload)
+
+    def _scan_payload(self, payload):
+        try:
+            chunk = json.loads(payload)
+        except ValueError:
+            return
+        if not isinstance(chunk, dict):
+            return
+        if self.chat_id is None:
+            self.chat_id = chunk.get("id")
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        if chunk.get("time_info"):
+            self.time_info = chunk["time_info"]
+        if chunk.get("error"):
+            error = chunk["error"]
+            self.error = error.get("message", str(error)) if isinstance(error, dict) else str(error)
+
+    def response_text(self):
+        parts = []
+        for payload in self.payloads:
+            if b'"content"' not in payload:
+                continue
+            try:
+                choices = json.loads(payload).get("choices")
+            except (ValueError, AttributeError):
+                continue
+            if choices:
+                content = (choices[0].get("delta") or {}).get("content")
+                if content:
+                    parts.append(content)
+        return "".join(parts)
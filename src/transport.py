@@ -0,0 +1,187 @@
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import socket
+import time
+from urllib.parse import urlsplit
+
+import httpcore
+import httpx
+from openai import DefaultAsyncHttpxClient
+
+from metrics import CallbackMetric
+from routing import route_catalog
+
+# HTTP/2 needs the optional `h2` package, fall back to HTTP/1.1 without it
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "true").lower() == "true"
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+UPSTREAM_DNS_TTL = float(os.getenv("UPSTREAM_DNS_TTL", "60"))
+
+# Per-provider transport settings, merged over the defaults above. Keys are
+# provider slugs from the model catalog or bare hostnames.
+PROVIDER_TRANSPORT = {
+    "openrouter": {"max_connections": 200, "max_keepalive_connections": 50},
+    "openai": {"max_connections": 200, "max_keepalive_connections": 50},
+}
+PROVIDER_TRANSPORT.update(json.loads(os.getenv("UPSTREAM_TRANSPORT_OVERRIDES", "{}")))
+
+
+def _origin(base_url):
+    """Normalize a base URL to the (scheme, host, port) its connections go to"""
+    if "://" not in base_url:
+        base_url = f"https://{base_url}"
+    parts = urlsplit(base_url)
+    scheme = parts.scheme or "https"
+    port = parts.port or (443 if scheme == "https" else 80)
+    return scheme, parts.hostname, port
+
+
+class DNSCache:
+    """In-process resolver cache, so new connections skip getaddrinfo"""
+
+    def __init__(self, ttl=UPSTREAM_DNS_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def resolve(self, host, port):
+        entry = self._entries.get((host, port))
+        now = time.monotonic()
+        if entry and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        self._entries[(host, port)] = (now + self.ttl, addresses)
+        return addresses
+
+    def invalidate(self, host, port):
+        self._entries.pop((host, port), None)
+
+
+class CachingNetworkBackend(httpcore.AsyncNetworkBackend):
+    """
+    Connects to cached addresses instead of resolving on every new connection.
+    TLS still uses the origin hostname for SNI and certificate checks, since
+    httpcore passes it separately to start_tls.
+    """
+
+    def __init__(self, dns_cache):
+        self.dns_cache = dns_cache
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        try:
+            addresses = await self.dns_cache.resolve(host, port)
+        except OSError:
+            addresses = [host]
+
+        last_error = None
+        for address in addresses:
+            try:
+                return await self._backend.connect_tcp(
+                    address, port, timeout=timeout, local_address=local_address, socket_options=socket_options
+                )
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                last_error = e
+        # Every cached address failed, the record is probably stale
+        self.dns_cache.invalidate(host, port)
+        raise last_error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self._backend.connect_unix_socket(path, timeout=timeout, socket_options=socket_options)
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+
+class ProviderTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, network_backend, ssl_context, limits, http2):
+        super().__init__(verify=ssl_context, limits=limits, http2=http2)
+        # httpx has no network_backend option, rebuild its pool with ours
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=ssl_context,
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            http1=True,
+            http2=http2,
+            network_backend=network_backend,
+        )
+
+
+class UpstreamTransport:
+    """
+    Shared outbound HTTP layer for provider traffic. Connections are pooled
+    per origin, so every provider and API key pointing at the same host share
+    one pool, and a slow host can only exhaust its own connection limit.
+    """
+
+    def __init__(self):
+        self.dns_cache = DNSCache()
+        self._network_backend = CachingNetworkBackend(self.dns_cache)
+        # One TLS context for all hosts, so certificates are loaded once
+        self._ssl_context = httpx.create_ssl_context()
+        self._clients = {}
+
+    def __len__(self):
+        return len(self._clients)
+
+    def settings(self, origin):
+        settings = {
+            "http2": UPSTREAM_HTTP2,
+            "max_connections": UPSTREAM_MAX_CONNECTIONS,
+            "max_keepalive_connections": UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+            "keepalive_expiry": UPSTREAM_KEEPALIVE_EXPIRY,
+        }
+        for provider, base_url in route_catalog.current.providers.items():
+            if provider in PROVIDER_TRANSPORT and _origin(base_url) == origin:
+                settings.update(PROVIDER_TRANSPORT[provider])
+        settings.update(PROVIDER_TRANSPORT.get(origin[1], {}))
+        return settings
+
+    def http_client(self, base_url):
+        origin = _origin(base_url)
+        client = self._clients.get(origin)
+        if client is None:
+            settings = self.settings(origin)
+            http2 = settings["http2"] and HTTP2_AVAILABLE and origin[0] == "https"
+            limits = httpx.Limits(
+                max_connections=settings["max_connections"],
+                max_keepalive_connections=settings["max_keepalive_connections"],
+                keepalive_expiry=settings["keepalive_expiry"],
+            )
+            transport = ProviderTransport(self._network_backend, self._ssl_context, limits, http2)
+            client = DefaultAsyncHttpxClient(transport=transport)
+            self._clients[origin] = client
+        return client
+
+    async def aclose(self):
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logging.error(f"Failed to close upstream transport: {e}")
+
+
+upstream_transport = UpstreamTransport()
+
+CallbackMetric("gateway_upstream_hosts", "Upstream hosts with an open connection pool", lambda: len(upstream_transport))
+CallbackMetric(
+    "gateway_dns_cache_lookups_total",
+    "Upstream DNS cache lookups by result",
+    lambda: {"hit": upstream_transport.dns_cache.hits, "miss": upstream_transport.dns_cache.misses},
+    ("result",),
+    metric_type="counter",
+)
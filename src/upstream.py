@@ -0,0 +1,148 @@
+import time
+from contextlib import AsyncExitStack
+
+from openai import AsyncStream
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from circuit import circuit_breakers, is_retryable, CircuitOpenError
+from clients import client_pool
+from hedging import hedger
+from key_pool import key_pools
+from metrics import observe_stage
+from sse import SSE_PASSTHROUGH
+
+# Header the OpenAI client reads to return the raw HTTP response instead of a parsed object
+RAW_RESPONSE_HEADER = "X-Stainless-Raw-Response"
+
+
+class UpstreamStream:
+    """A streaming completion that has already produced its first chunk"""
+
+    def __init__(self, stack, iterator, first, headers):
+        self.stack = stack
+        self.iterator = iterator
+        self.first = first
+        self.headers = headers
+
+    async def chunks(self):
+        if self.first is not None:
+            yield self.first
+        async for chunk in self.iterator:
+            yield chunk
+
+    async def aclose(self):
+        await self.stack.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+def post_completion(client, body, stream=False, raw=None):
+    """
+    POST an already encoded chat completion body. raw is "true" for the
+    parsed response with its headers, or "stream" for the undecoded stream.
+    """
+    return client.post(
+        "/chat/completions",
+        cast_to=ChatCompletionChunk if stream else ChatCompletion,
+        body=body,
+        options={"headers": {RAW_RESPONSE_HEADER: raw}} if raw else {},
+        stream=stream,
+        stream_cls=AsyncStream[ChatCompletionChunk],
+    )
+
+
+async def open_upstream_stream(base_url, api_key, model_name, request, labels, max_retries=None):
+    """Start a streaming completion of the caller's request and wait for its first chunk"""
+    connect_start = time.perf_counter()
+    # Usage is always requested, the gateway needs it for analytics and limits
+    body = request.body(
+        model=model_name, stream=True,
+        stream_options=dict(request.get("stream_options") or {}, include_usage=True)
+    )
+    stack = AsyncExitStack()
+    try:
+        client = await stack.enter_async_context(client_pool.lease(base_url, api_key, max_retries))
+        if SSE_PASSTHROUGH:
+            response = await post_completion(client, body, stream=True, raw="stream")
+            stack.push_async_callback(response.close)
+            iterator = response.iter_bytes()
+            headers = response.headers
+        else:
+            stream = await post_completion(client, body, stream=True)
+            stack.push_async_callback(stream.close)
+            iterator = stream.__aiter__()
+            headers = stream.response.headers
+        observe_stage("upstream_connect", time.perf_counter() - connect_start, **labels)
+        first = await anext(iterator, None)
+    except BaseException:
+        await stack.aclose()
+        raise
+    return UpstreamStream(stack, iterator, first, headers)
+
+
+def pooled_key_retries(route):
+    # A rate limited pooled key is swapped for another one instead of retried
+    return 0 if route.api_key is None else None
+
+
+async def call_routes(routes, attempt, kind, hedging, release=None):
+    """
+    Run attempt(route) against the candidate routes in priority order,
+    skipping routes whose circuit is open and moving on when a provider
+    fails. Hedges go to the next available route, or the same one.
+    """
+    last_error = None
+    for index, route in enumerate(routes):
+        if not circuit_breakers.allow(route):
+            continue
+        backup = next((other for other in routes[index + 1:] if circuit_breakers.available(other)), route)
+        try:
+            return await hedger.race(
+                (route.provider, route.model, kind),
+                lambda route=route: circuit_breakers.call(route, attempt),
+                (lambda: circuit_breakers.call(backup, attempt)) if hedging else None,
+                release=release,
+            )
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            print(f"Route {route.provider}/{route.model} failed: {e}")
+            last_error = e
+    if last_error:
+        raise last_error
+    raise CircuitOpenError(f"Error code: 503 - circuit open for every route of {routes[0].provider}/{routes[0].model}")
+
+
+async def create_completion(routes, request, hedging=False):
+    """Non-streaming chat completion of the caller's request over the candidate routes, returns ((route, completion), hedge)"""
+    async def request_upstream(route):
+        async def request_completion(route_api_key):
+            async with client_pool.lease(route.base_url, route_api_key, pooled_key_retries(route)) as client:
+                raw = await post_completion(client, request.body(model=route.model, stream=False), raw="true")
+            return raw.parse(), raw.headers
+
+        return route, await key_pools.call(route, request_completion)
+
+    return await call_routes(routes, request_upstream, "response", hedging)
+
+
+async def create_embedding(routes, inputs, **params):
+    """Embeddings over the candidate routes, returns (route, response)"""
+    async def request_upstream(route):
+        async def request_embedding(route_api_key):
+            async with client_pool.lease(route.base_url, route_api_key, pooled_key_retries(route)) as client:
+                raw = await client.embeddings.with_raw_response.create(
+                    input=inputs,
+                    model=route.model,
+                    **params
+                )
+            return raw.parse(), raw.headers
+
+        return route, await key_pools.call(route, request_embedding)
+
+    result, _ = await call_routes(routes, request_upstream, "embedding", False)
+    return result
@@ -1,51 +1,71 @@
 from sqlalchemy.event import api
-from routing import MODEL_TO_PROVIDER, PROVIDER_TO_BASEURL
+from routing import route_catalog
 from fastapi import Depends, HTTPException
-from db import Gateway, get_db
-from routing import MODEL_COST
+from db import get_db
 from cachetools import TTLCache
 import hashlib
+import hmac
 import json
 import os
 import random
 from typing import Optional
 from fastapi import Header
-from db import User
+from key_pool import key_pools, FREE_PROVIDER
+from auth_cache import auth_cache
 from dotenv import load_dotenv
 
 load_dotenv()
 
-
-def resolve_route(model_name: str):
-    print(model_name)
-    
-    if model_name ==  "free":
-        api_key = os.getenv("FREE_MODEL_API_KEY")
-        return "gemini-2.5-flash", "playground", "https://generativelanguage.googleapis.com/v1beta/openai/", api_key
-        
-    if "/" in model_name:
-        provider, model_name = model_name.split("/", 1)
-    else:
-        provider = MODEL_TO_PROVIDER.get(model_name)
-        
-    if not provider:
-        raise HTTPException(400, "Provider must be specified for unknown model")
-
-    if provider not in PROVIDER_TO_BASEURL:
-        raise HTTPException(400, f"Provider not available: {provider}")
-        
-    base_url = PROVIDER_TO_BASEURL.get(provider)
-    if not base_url:
-        raise HTTPException(500, f"No base URL configured for provider {provider}")
-    return model_name, provider, base_url, None
+# Token for the /admin endpoints, which are disabled without one
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+def resolve_single_route(model_name: str, catalog=None):
+    """The route for a model, alias or provider/model in the catalog in use"""
+    return (catalog or route_catalog.current).resolve(model_name)
+
+
+def resolve_route(model_name: str, api_key: Optional[str] = None):
+    """
+    Candidate routes for a model in priority order: the primary route, then its
+    fallback chain. The caller's api_key is only sent to the primary route's
+    provider; fallbacks to other providers use that provider's key pool, and
+    are left out when it has none.
+    """
+    # One catalog for the whole chain, even if a reload lands meanwhile
+    catalog = route_catalog.current
+    primary = resolve_single_route(model_name, catalog)
+    routes = [primary]
+    fallbacks = catalog.fallbacks.get(f"{primary.provider}/{primary.model}") or catalog.fallbacks.get(model_name, [])
+    for fallback in fallbacks:
+        try:
+            route = resolve_single_route(fallback, catalog)
+        except HTTPException as e:
+            print(f"Skipping fallback route {fallback}: {e.detail}")
+            continue
+        if (route.provider, route.model) not in catalog.prices:
+            # Priced like the route it stands in for, rather than logged as free during an outage
+            route = route._replace(input_cost=primary.input_cost, output_cost=primary.output_cost)
+        routes.append(route)
+
+    candidates = []
+    for route in routes:
+        if route.provider == primary.provider:
+            # The free provider is served with the gateway's own keys when it has them
+            own_key = None if route.provider == FREE_PROVIDER and key_pools.has_pool(route.provider) else api_key
+        elif key_pools.has_pool(route.provider):
+            own_key = None
+        else:
+            # No key of ours for this provider, and the caller's key must not be sent to it
+            continue
+        candidates.append(route._replace(api_key=own_key))
+    return candidates
     
     
-def validate_gateway(gateway_id, auth, db):
-    gw = db.query(Gateway).filter(Gateway.id == gateway_id).first()
-    if not gw:
-        return None
-
-    if gw.secret_key != auth:
+async def validate_gateway(gateway_id, auth, db):
+    """The cached gateway if auth is its secret, otherwise None"""
+    gw = await auth_cache.gateway(gateway_id, db)
+    if not gw or not gw.check_secret(auth):
         return None
 
     return gw
@@ -72,19 +92,9 @@ def get_cost(
     prompt_tokens: int, 
     completion_tokens: int
 ):
-    dict_key_name = f"{provider_name}:{model_name}"
-    
-    
-    model_data = MODEL_COST.get(dict_key_name)
-    print(model_data)
-    print("**********")
-    if not model_data:
-        return 0.0
-    
-    input_cost = (prompt_tokens / 1_000_000) * model_data["input_per_million"]
-    output_cost = (completion_tokens / 1_000_000) * model_data["output_per_million"]
-
-    return input_cost + output_cost
+    """Cost of a call from its model and provider names; Route.cost() skips the price lookup"""
+    input_cost, output_cost = route_catalog.current.price(provider_name, model_name)
+    return prompt_tokens * input_cost + completion_tokens * output_cost
 
 
 
@@ -101,6 +111,24 @@ def make_cache_key(gateway_id: str, days: int, include_logs: bool):
     return hashlib.sha256(raw.encode()).hexdigest()
 
 
+def make_request_key(gateway_id: str, model: str, prompt_text: str, params: dict, api_key: Optional[str] = None):
+    """Canonical hash of a completion request, used to detect identical requests"""
+    raw = json.dumps(
+        {
+            "gateway_id": gateway_id,
+            "model": model,
+            # The messages as the caller sent them, hashed without decoding them again
+            "messages": hashlib.sha256(prompt_text.encode()).hexdigest(),
+            "params": params,
+            # Requests made with different upstream keys are never shared
+            "api_key": hashlib.sha256(api_key.encode()).hexdigest() if api_key else None,
+        },
+        sort_keys=True,
+        separators=(",", ":")
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
 
 # Group 1: adjectives + colors
 group1 = ["Brave", "Sneaky", "Gentle", "Fierce", "Curious", "Misty", "Electric",
@@ -120,8 +148,15 @@ async def get_current_user(x_user_id: Optional[str] = Header(None, alias="x-user
     if not x_user_id:
         raise HTTPException(status_code=401, detail="X-User-ID header required")
 
-    user = db.query(User).filter(User.id == x_user_id).first()
+    user = await auth_cache.user(x_user_id, db)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid user ID")
 
-    return user
\ No newline at end of file
+    return user
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None, alias="x-admin-token")):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API disabled, set ADMIN_TOKEN to enable it")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")